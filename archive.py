@@ -0,0 +1,168 @@
+import datetime
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import metrics
+from profiling import stop_inherited_profiling
+from response_cache import compress, decompress
+
+ARCHIVE_DIR = "archive"
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class HtmlArchive:
+    """
+    Append-only archive of raw offer pages. Pages are compressed one by
+    one and appended to segment files in one directory per day of fetch,
+    every segment has .idx file next to it with one line per page:
+    offer id, fetch timestamp, offset, length and codec. A new segment is
+    started on every run and once current one exceeds segment_size bytes,
+    so existing segments are never modified
+    """
+
+    def __init__(self, path=ARCHIVE_DIR, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.day = None
+        self.data = None
+        self.index = None
+
+    def open_segment(self, day):
+        self.close()
+
+        day_dir = os.path.join(self.path, day)
+        os.makedirs(day_dir, exist_ok=True)
+
+        number = len(glob.glob(os.path.join(day_dir, "*.seg"))) + 1
+        segment_path = os.path.join(day_dir, f"{number:05d}_{os.getpid()}.seg")
+
+        self.day = day
+        self.data = open(segment_path, "ab")
+        self.index = open(f"{os.path.splitext(segment_path)[0]}.idx", "a")
+
+    def append(self, offer_id, fetch_timestamp, body):
+        day = fetch_timestamp.date().isoformat()
+        if self.data is None or day != self.day:
+            self.open_segment(day)
+        elif self.data.tell() > self.segment_size:
+            self.open_segment(day)
+
+        codec, data = compress(body)
+        offset = self.data.tell()
+        self.data.write(data)
+        self.data.flush()
+
+        # Index line goes after the data, page cut off by a crash is skipped
+        fields = [offer_id, fetch_timestamp.isoformat(), offset, len(data), codec]
+        self.index.write("\t".join([str(field) for field in fields]) + "\n")
+        self.index.flush()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.index.close()
+            self.data = None
+            self.index = None
+
+
+def list_segments(path=ARCHIVE_DIR):
+    """
+    Segment files under path, either whole archive or one day directory
+    """
+    return sorted(glob.glob(os.path.join(path, "**", "*.seg"), recursive=True))
+
+
+def read_segment(segment_path):
+    """
+    Yields (offer_id, fetch_timestamp, body) of every page indexed in
+    segment. Segment is read at once, pages are sliced out by offset
+    """
+    with open(segment_path, "rb") as f:
+        data = f.read()
+
+    with open(f"{os.path.splitext(segment_path)[0]}.idx") as f:
+        for line in f:
+            offer_id, fetch_timestamp, offset, length, codec = line.split()
+            offset, length = int(offset), int(length)
+
+            yield (
+                offer_id,
+                datetime.datetime.fromisoformat(fetch_timestamp),
+                decompress(codec, data[offset : offset + length]),
+            )
+
+
+def parse_segment(segment_path, parse):
+    """
+    Parses every page of segment, runs in worker process.
+    Returns parsed offers and ids of pages that failed to parse
+    """
+    offers = list()
+    failed = list()
+
+    for offer_id, fetch_timestamp, body in read_segment(segment_path):
+        try:
+            offer_params = parse(body)
+        except (AttributeError, KeyError, ValueError, TypeError):
+            failed.append(offer_id)
+            continue
+
+        offer = dict()
+        offer["create_timestamp"] = fetch_timestamp
+        offer["id"] = offer_id
+        offers.append({**offer, **offer_params})
+
+    return offers, failed
+
+
+def replay(logger, path, parse, save, processes=None, batch_size=1000):
+    """
+    Parses archived pages again without network, one segment per task
+    in a pool of processes (threads with processes=0), and passes
+    offers to save() in batches. Offers keep timestamps of the
+    original fetch
+    """
+    segments = list_segments(path)
+    logger.info(f"Replaying {len(segments)} archive segments from {path}")
+
+    processed = 0
+    failed = 0
+    results = list()
+
+    # Like in fetch_offers(), processes=0 parses in threads
+    if processes == 0:
+        executor = ThreadPoolExecutor()
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=processes, initializer=stop_inherited_profiling
+        )
+
+    with executor:
+        futures = {
+            executor.submit(parse_segment, segment, parse): segment
+            for segment in segments
+        }
+
+        for future in as_completed(futures):
+            offers, failed_ids = future.result()
+            processed += len(offers) + len(failed_ids)
+            failed += len(failed_ids)
+            metrics.inc("offers_processed_total", len(offers) + len(failed_ids))
+
+            if failed_ids:
+                logger.warning(
+                    f"Parsing failed for {len(failed_ids)} pages of {futures[future]}"
+                )
+
+            results.extend(offers)
+            while len(results) >= batch_size:
+                save(results[:batch_size])
+                del results[:batch_size]
+
+            logger.info(f"{processed} offers processed")
+
+    if results:
+        save(results)
+
+    logger.info(f"{processed} archived offers replayed, {failed} failed to parse")
@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import fetcher
+import otodom_listings_crawler
+from normalize import normalize_offers
+from otodom_offers_scrapper import scrapper_loop
+from parsers import DEFAULT_BACKEND, FIXTURES_DIR, OFFER_PARSERS
+
+APP_NAME = "otodom_benchmark"
+RESULTS_DIR = "benchmarks"
+SCENARIOS = ["offers", "listings", "parsers"]
+LISTING_ITEMS = 36
+
+# Offer page used when there are no recorded pages in fixtures/offers,
+# readable by every parser backend
+OFFER_PAGE = """<html><head><script id="__NEXT_DATA__" type="application/json">
+{"props":{"pageProps":{"ad":{"characteristics":[
+{"key":"price","value":"612000","label":"Cena","localizedValue":"612 000 zł"},
+{"key":"m","value":"57","label":"Powierzchnia","localizedValue":"57 m²"},
+{"key":"price_per_m","value":"10737","label":"Cena za metr kwadratowy",
+"localizedValue":"10 737 zł/m²"},
+{"key":"rooms_num","value":"3","label":"Liczba pokoi","localizedValue":"3"},
+{"key":"floor_no","value":"floor_2","label":"Piętro","localizedValue":"2/4"}],
+"location":{"coordinates":{"latitude":52.27,"longitude":20.98},
+"address":{"district":{"name":"Żoliborz"},"city":{"name":"Warszawa"}}}}}}}
+</script></head><body>
+<strong aria-label="Cena">612 000 zł</strong>
+<div aria-label="Cena za metr kwadratowy">10 737 zł/m²</div>
+<a aria-label="Adres">Żoliborz, Warszawa</a>
+<div aria-label="Powierzchnia"><div><div class="css-1wi2w6s enb64yk4">57 m²</div></div></div>
+<div aria-label="Liczba pokoi"><div><div class="css-1wi2w6s enb64yk4">3</div></div></div>
+<div aria-label="Piętro"><div><div class="css-1wi2w6s enb64yk4">2/4</div></div></div>
+</body></html>"""
+
+
+def load_offer_pages(fixtures_dir=FIXTURES_DIR):
+    """
+    Recorded offer pages from fixtures, built-in page if there are none
+    """
+    pages = list()
+    for html_path in sorted(glob.glob(os.path.join(fixtures_dir, "offers", "*.html"))):
+        with open(html_path, "rb") as f:
+            pages.append(f.read())
+
+    return pages or [OFFER_PAGE.encode("utf-8")]
+
+
+def listing_page(page, total_pages):
+    """
+    Listing page with offer ids and pagination in __NEXT_DATA__ JSON
+    """
+    items = [{"slug": f"offer-{page}-{i}-ID{page}x{i}"} for i in range(LISTING_ITEMS)]
+    pagination = {
+        "totalPages": total_pages,
+        "currentPage": page,
+        "itemsPerPage": LISTING_ITEMS,
+        "totalItems": total_pages * LISTING_ITEMS,
+    }
+    search_ads = {"items": items, "pagination": pagination}
+    data = {"props": {"pageProps": {"data": {"searchAds": search_ads}}}}
+
+    return (
+        '<html><head><script id="__NEXT_DATA__" type="application/json">'
+        f"{json.dumps(data)}</script></head></html>"
+    ).encode("utf-8")
+
+
+class MockOtodom(ThreadingHTTPServer):
+    """
+    Local stand-in for otodom serving offer and listing pages with
+    latency (seconds, +-50% jitter), share of 500 responses and share
+    of 429 responses with Retry-After
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        offer_pages,
+        listing_pages=100,
+        latency=0.05,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after=1,
+    ):
+        super().__init__(("127.0.0.1", 0), MockOtodomHandler)
+        self.offer_pages = offer_pages
+        self.listing_pages = listing_pages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.statuses = dict()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, status):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class MockOtodomHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        draw = random.random()
+
+        if draw < server.throttle_rate:
+            self.respond(429, b"", {"Retry-After": str(server.retry_after)})
+            return
+
+        if draw < server.throttle_rate + server.error_rate:
+            self.respond(500, b"")
+            return
+
+        time.sleep(server.latency * random.uniform(0.5, 1.5))
+
+        path = urlsplit(self.path)
+        if path.path.startswith("/pl/oferta/"):
+            offer_id = path.path.rsplit("/", 1)[-1]
+            pages = server.offer_pages
+            body = pages[zlib.crc32(offer_id.encode("utf-8")) % len(pages)]
+        elif path.path.startswith("/pl/oferty/"):
+            page = int(parse_qs(path.query).get("page", ["1"])[0])
+            body = listing_page(page, server.listing_pages)
+        else:
+            self.respond(404, b"")
+            return
+
+        self.respond(200, body, {"Content-Type": "text/html; charset=utf-8"})
+
+    def respond(self, status, body, headers=None):
+        self.server.count(status)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def latency_stats(latencies):
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def timed(fetch, latencies):
+    """
+    Wraps async fetch function to record latency of every call
+    """
+
+    @functools.wraps(fetch)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fetch(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def bench_offers(logger, base_url, offers, concurrency, rate, processes, backend):
+    """
+    Runs scrapper_loop() against mock server, offers are normalised
+    but not saved
+    """
+    latencies = list()
+    fetcher.fetch_page = timed(fetcher.fetch_page, latencies)
+    saved = 0
+
+    def save(results):
+        nonlocal saved
+        saved += len(normalize_offers(results))
+
+    start = time.perf_counter()
+    scrapper_loop(
+        logger,
+        [f"offer-{i}-ID{i}" for i in range(offers)],
+        concurrency,
+        rate,
+        dry_run=False,
+        backend=backend,
+        processes=processes,
+        max_rate=rate * 4 if rate > 0 else None,
+        save=save,
+        offer_url=f"{base_url}/pl/oferta/{{}}",
+    )
+    seconds = time.perf_counter() - start
+
+    return {
+        "pages": offers,
+        "saved": saved,
+        "seconds": round(seconds, 3),
+        "pages_per_second": round(offers / seconds, 2),
+        **latency_stats(latencies),
+    }
+
+
+def bench_listings(logger, base_url, listing_pages, concurrency, rate):
+    """
+    Runs http listings crawler against mock server, offer ids are not
+    saved
+    """
+    latencies = list()
+    otodom_listings_crawler.fetch = timed(otodom_listings_crawler.fetch, latencies)
+    saved = 0
+
+    def save(df):
+        nonlocal saved
+        saved += len(df)
+
+    start = time.perf_counter()
+    asyncio.run(
+        otodom_listings_crawler.http_crawler(
+            logger,
+            f"{base_url}/pl/oferty/sprzedaz/mieszkanie/warszawa?viewType=listing",
+            wait=1 / rate if rate > 0 else 0,
+            concurrency=concurrency,
+            save=save,
+        )
+    )
+    seconds = time.perf_counter() - start
+
+    return {
+        "pages": listing_pages,
+        "saved": saved,
+        "seconds": round(seconds, 3),
+        "pages_per_second": round(listing_pages / seconds, 2),
+        **latency_stats(latencies),
+    }
+
+
+def bench_parsers(logger, offer_pages, repeat):
+    """
+    Parses offer pages repeat times with every backend in this process
+    """
+    backends = dict()
+
+    for backend, parse in OFFER_PARSERS.items():
+        latencies = list()
+        failed = 0
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for content in offer_pages:
+                page_start = time.perf_counter()
+                try:
+                    parse(content)
+                except (AttributeError, KeyError, ValueError, TypeError):
+                    failed += 1
+                latencies.append(time.perf_counter() - page_start)
+        seconds = time.perf_counter() - start
+
+        backends[backend] = {
+            "pages": len(latencies),
+            "failed": failed,
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(len(latencies) / seconds, 2),
+            **latency_stats(latencies),
+        }
+
+    return {"backends": backends}
+
+
+def run_scenario(target, kwargs, results):
+    """
+    Runs benchmark in child process, so that its CPU time and peak RSS
+    (with its own worker processes) are measured separately
+    """
+    logger = logging.getLogger(APP_NAME)
+    logger.setLevel(logging.WARNING)
+
+    result = target(logger, **kwargs)
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+    result["cpu_seconds"] = round(cpu_seconds, 3)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_mb"] = round(max(own.ru_maxrss, children.ru_maxrss) / 1024, 1)
+    results.put(result)
+
+
+def run_in_process(target, **kwargs):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=run_scenario, args=(target, kwargs, results)
+    )
+    process.start()
+    result = results.get()
+    process.join()
+
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenarios",
+        help="benchmarks to run",
+        nargs="+",
+        choices=SCENARIOS,
+        default=SCENARIOS,
+    )
+    parser.add_argument(
+        "--offers", help="offer pages to scrape", type=int, default=2000
+    )
+    parser.add_argument(
+        "--listing_pages", help="pages of listing to crawl", type=int, default=200
+    )
+    parser.add_argument(
+        "--parser_repeat", help="times every page is parsed", type=int, default=200
+    )
+    parser.add_argument(
+        "--latency", help="mean server latency in ms", type=float, default=50
+    )
+    parser.add_argument(
+        "--error_rate", help="share of 500 responses", type=float, default=0.01
+    )
+    parser.add_argument(
+        "--throttle_rate", help="share of 429 responses", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--retry_after", help="Retry-After of 429 responses", type=int, default=1
+    )
+    parser.add_argument("--concurrency", help="requests at once", type=int, default=16)
+    parser.add_argument(
+        "--rate",
+        help="starting requests per second, 0: no limit",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--processes", help="parser processes (default: CPU count)", type=int
+    )
+    parser.add_argument(
+        "--parser",
+        help="offer page parser",
+        choices=list(OFFER_PARSERS),
+        default=DEFAULT_BACKEND,
+    )
+    parser.add_argument(
+        "--fixtures", help="directory with recorded pages", default=FIXTURES_DIR
+    )
+    parser.add_argument("--output", help="results JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
+    logger = logging.getLogger(APP_NAME)
+    logger.info(f"Starting {APP_NAME}")
+
+    offer_pages = load_offer_pages(args.fixtures)
+    logger.info(f"{len(offer_pages)} offer pages to serve")
+
+    server = MockOtodom(
+        offer_pages,
+        listing_pages=args.listing_pages,
+        latency=args.latency / 1000,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Mock otodom listening on {server.url}")
+
+    results = dict()
+
+    if "offers" in args.scenarios:
+        logger.info(f"Scraping {args.offers} offers")
+        results["offers"] = run_in_process(
+            bench_offers,
+            base_url=server.url,
+            offers=args.offers,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            processes=args.processes,
+            backend=args.parser,
+        )
+
+    if "listings" in args.scenarios:
+        logger.info(f"Crawling {args.listing_pages} listing pages")
+        results["listings"] = run_in_process(
+            bench_listings,
+            base_url=server.url,
+            listing_pages=args.listing_pages,
+            concurrency=args.concurrency,
+            rate=args.rate,
+        )
+
+    if "parsers" in args.scenarios:
+        logger.info("Parsing offer pages with every backend")
+        results["parsers"] = run_in_process(
+            bench_parsers, offer_pages=offer_pages, repeat=args.parser_repeat
+        )
+
+    server.shutdown()
+
+    report = {
+        "commit": get_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "server_statuses": {str(k): v for k, v in sorted(server.statuses.items())},
+        "results": results,
+    }
+
+    output = args.output
+    if output is None:
+        log_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{log_timestamp}_{report['commit']}.json")
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        print(f"[{name}] {json.dumps(result)}")
+
+    logger.info(f"Results saved into {output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,119 @@
+import contextlib
+import queue
+import threading
+
+from selenium.common.exceptions import WebDriverException
+
+MAX_PAGES = 50
+
+
+class PooledBrowser:
+    """
+    Single reusable driver of BrowserPool, started lazily and started
+    again after max_pages pages or when it stops responding
+    """
+
+    def __init__(self, create_driver, max_pages=MAX_PAGES, logger=None):
+        self.create_driver = create_driver
+        self.max_pages = max_pages
+        self.logger = logger
+        self.driver = None
+        self.pages = 0
+
+    def start(self):
+        self.quit()
+        self.driver = self.create_driver()
+        self.pages = 0
+
+    def restart(self):
+        if self.logger is not None:
+            self.logger.info(f"Restarting browser after {self.pages} pages")
+
+        self.start()
+
+    def quit(self):
+        if self.driver is None:
+            return
+
+        try:
+            self.driver.quit()
+        except WebDriverException as e:
+            if self.logger is not None:
+                self.logger.warning(f"Browser did not quit cleanly ({e!r})")
+        finally:
+            self.driver = None
+
+    def is_healthy(self):
+        if self.driver is None:
+            return False
+
+        try:
+            self.driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def count_page(self):
+        """
+        Counts page loaded by driver, returns True when driver
+        should be recycled
+        """
+        self.pages += 1
+        return self.pages >= self.max_pages
+
+
+class BrowserPool:
+    """
+    Pool of size reusable drivers created with create_driver(). Drivers
+    are checked before every lease, recycled after max_pages pages and
+    quit when pool is closed, also on errors when used as context manager
+    """
+
+    def __init__(self, create_driver, size=1, max_pages=MAX_PAGES, logger=None):
+        self.logger = logger
+        self.browsers = [
+            PooledBrowser(create_driver, max_pages, logger) for _ in range(size)
+        ]
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        for browser in self.browsers:
+            self.idle.put(browser)
+
+    @contextlib.contextmanager
+    def browser(self):
+        """
+        Leases healthy browser for the time of with block
+        """
+        browser = self.idle.get()
+        try:
+            if not browser.is_healthy():
+                browser.start()
+
+            yield browser
+
+            if browser.pages >= browser.max_pages:
+                browser.quit()
+        except BaseException:
+            # Browser state after error is unknown
+            browser.quit()
+            raise
+        finally:
+            with self.lock:
+                if self.closed:
+                    browser.quit()
+            self.idle.put(browser)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+        for browser in self.browsers:
+            browser.quit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
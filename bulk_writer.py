@@ -0,0 +1,176 @@
+import datetime
+import io
+
+NULL = "\\N"
+ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def format_value(value):
+    """
+    Formats single value in PostgreSQL COPY text format
+    """
+    if value is None or value != value:  # None or NaN
+        return NULL
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+
+    return str(value).translate(ESCAPES)
+
+
+def rows_to_buffer(rows):
+    """
+    Writes rows into in-memory buffer in COPY text format
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join([format_value(value) for value in row]))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    return buffer
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def copy_rows(
+    engine,
+    table_name,
+    columns,
+    rows,
+    upsert_keys=None,
+    day_column="create_timestamp",
+):
+    """
+    Streams rows into table with COPY FROM STDIN. With upsert_keys rows
+    are copied into a staging table first and replace target rows with
+    the same keys (and the same day of day_column, if it is copied)
+    """
+    buffer = rows_to_buffer(rows)
+    columns_sql = ", ".join([quote(c) for c in columns])
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+
+        if upsert_keys:
+            staging_name = f"staging_{table_name}"
+            cursor.execute(
+                f"create temp table {quote(staging_name)} "
+                f"(like public.{quote(table_name)} including defaults) on commit drop"
+            )
+            cursor.copy_expert(
+                f"copy {quote(staging_name)} ({columns_sql}) from stdin", buffer
+            )
+
+            match = [f"t.{quote(k)} = s.{quote(k)}" for k in upsert_keys]
+            if day_column in columns and day_column not in upsert_keys:
+                match.append(
+                    f"t.{quote(day_column)} >= date_trunc('day', s.{quote(day_column)})"
+                )
+                match.append(
+                    f"t.{quote(day_column)} < date_trunc('day', s.{quote(day_column)})"
+                    " + interval '1 day'"
+                )
+
+            cursor.execute(
+                f"delete from public.{quote(table_name)} t "
+                f"using {quote(staging_name)} s where {' and '.join(match)}"
+            )
+            cursor.execute(
+                f"insert into public.{quote(table_name)} ({columns_sql}) "
+                f"select {columns_sql} from {quote(staging_name)}"
+            )
+        else:
+            cursor.copy_expert(
+                f"copy public.{quote(table_name)} ({columns_sql}) from stdin", buffer
+            )
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def dataframe_rows(df):
+    """
+    Rows of DataFrame as tuples, missing values of every dtype (NaN,
+    NaT, pd.NA) become None
+    """
+    values = df.astype(object).where(df.notna(), None)
+
+    return values.itertuples(index=False, name=None)
+
+
+def copy_dataframe(engine, table_name, df, upsert_keys=None):
+    """
+    Streams DataFrame into table with COPY FROM STDIN
+    """
+    rows = dataframe_rows(df)
+
+    copy_rows(engine, table_name, list(df.columns), rows, upsert_keys=upsert_keys)
+
+
+def copy_versions(
+    engine,
+    table_name,
+    columns,
+    rows,
+    key_column="id",
+    hash_column="params_hash",
+    valid_from_column="valid_from",
+    valid_to_column="valid_to",
+):
+    """
+    Streams rows into history table with COPY FROM STDIN through a
+    staging table, keeping only changes. Rows with the same hash as the
+    current version of their key, or not newer than it, are dropped,
+    current versions of changed keys get valid_to and changed rows
+    are inserted as current versions. Returns number of rows inserted
+    """
+    buffer = rows_to_buffer(rows)
+    columns_sql = ", ".join([quote(c) for c in columns])
+    staging_name = quote(f"staging_{table_name}")
+    table_name = f"public.{quote(table_name)}"
+    key, row_hash = quote(key_column), quote(hash_column)
+    valid_from, valid_to = quote(valid_from_column), quote(valid_to_column)
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"create temp table {staging_name} "
+            f"(like {table_name} including defaults) on commit drop"
+        )
+        cursor.copy_expert(f"copy {staging_name} ({columns_sql}) from stdin", buffer)
+
+        cursor.execute(
+            f"delete from {staging_name} s using {table_name} t "
+            f"where t.{key} = s.{key} and t.{valid_to} is null "
+            f"and (t.{row_hash} = s.{row_hash} or t.{valid_from} >= s.{valid_from})"
+        )
+        cursor.execute(
+            f"update {table_name} t set {valid_to} = s.{valid_from} "
+            f"from {staging_name} s where t.{key} = s.{key} and t.{valid_to} is null"
+        )
+        cursor.execute(
+            f"insert into {table_name} ({columns_sql}) "
+            f"select {columns_sql} from {staging_name}"
+        )
+        inserted = cursor.rowcount
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return inserted
@@ -0,0 +1,115 @@
+import datetime
+import itertools
+import sqlite3
+import threading
+
+RUN_STATE_PATH = "run_state.sqlite"
+
+# Offer ids checked against checkpoint in one query, below SQLite
+# limit of query parameters
+FILTER_CHUNK_SIZE = 500
+
+
+class RunState:
+    """
+    Durable progress of a single run kept in local SQLite file: offer ids
+    already saved and listing pages already crawled. Safe to use from
+    threads
+    """
+
+    def __init__(self, run_id, path=RUN_STATE_PATH):
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "create table if not exists offers_done "
+                "(run_id text, offer_id text, done_at text, "
+                "primary key (run_id, offer_id))"
+            )
+            self.conn.execute(
+                "create table if not exists listing_pages_done "
+                "(run_id text, listing_url text, page integer, done_at text, "
+                "primary key (run_id, listing_url, page))"
+            )
+
+    def reset(self):
+        """
+        Forgets progress of this run, used when run is not resumed
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "delete from offers_done where run_id = ?", (self.run_id,)
+            )
+            self.conn.execute(
+                "delete from listing_pages_done where run_id = ?", (self.run_id,)
+            )
+
+    def count_done_offers(self):
+        with self.lock:
+            result = self.conn.execute(
+                "select count(*) from offers_done where run_id = ?", (self.run_id,)
+            )
+            return result.fetchone()[0]
+
+    def pending_offer_ids(self, offer_ids, chunk_size=FILTER_CHUNK_SIZE):
+        """
+        Yields offer ids not saved yet, checking them against checkpoint
+        in chunks, so ids can come from iterator of any length
+        """
+        offer_ids = iter(offer_ids)
+
+        while chunk := list(itertools.islice(offer_ids, chunk_size)):
+            placeholders = ", ".join("?" * len(chunk))
+            with self.lock:
+                result = self.conn.execute(
+                    "select offer_id from offers_done "
+                    f"where run_id = ? and offer_id in ({placeholders})",
+                    (self.run_id, *chunk),
+                )
+                done = {row[0] for row in result}
+
+            yield from (offer_id for offer_id in chunk if offer_id not in done)
+
+    def mark_offers_done(self, offer_ids):
+        now = datetime.datetime.now().isoformat()
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert or ignore into offers_done values (?, ?, ?)",
+                [(self.run_id, offer_id, now) for offer_id in offer_ids],
+            )
+
+    def done_pages(self, listing_url):
+        with self.lock:
+            result = self.conn.execute(
+                "select page from listing_pages_done "
+                "where run_id = ? and listing_url = ?",
+                (self.run_id, listing_url),
+            )
+            return {row[0] for row in result}
+
+    def last_page(self, listing_url):
+        """
+        Last page of listing crawled without gaps, 0 if none
+        """
+        done = self.done_pages(listing_url)
+
+        page = 0
+        while page + 1 in done:
+            page += 1
+
+        return page
+
+    def mark_page_done(self, listing_url, page):
+        now = datetime.datetime.now().isoformat()
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "insert or ignore into listing_pages_done values (?, ?, ?, ?)",
+                (self.run_id, listing_url, page, now),
+            )
+
+    def close(self):
+        self.conn.close()
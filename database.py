@@ -0,0 +1,75 @@
+import datetime
+
+from sqlalchemy import create_engine
+
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_PRE_PING = True
+POOL_RECYCLE = 1800
+
+_engines = dict()
+
+
+def get_url(credentials):
+    return (
+        f"postgresql://{credentials['username']}:{credentials['password']}"
+        f"@{credentials['host']}:{credentials['port']}/{credentials['database']}"
+    )
+
+
+def get_engine(
+    credentials=None,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_pre_ping=POOL_PRE_PING,
+):
+    """
+    Returns process wide pooled engine for PostgreSQL DB, engine is
+    created on first use from credentials (get_creds() by default)
+    and reused by every following read and write
+    """
+    if credentials is None:
+        from utils import get_creds
+
+        credentials = get_creds()
+
+    url = get_url(credentials)
+
+    if url not in _engines:
+        _engines[url] = create_engine(
+            url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=POOL_RECYCLE,
+        )
+
+    return _engines[url]
+
+
+def dispose_engines():
+    """
+    Closes all pooled connections, e.g. at exit or after fork
+    """
+    for engine in _engines.values():
+        engine.dispose()
+
+    _engines.clear()
+
+
+def day_range(date_from, date_to=None):
+    """
+    Half-open timestamp range [date_from 00:00, date_to + 1 day 00:00)
+    covering whole days, so that filters can use create_timestamp index
+    """
+    if isinstance(date_from, str):
+        date_from = datetime.date.fromisoformat(date_from)
+    if date_to is None or date_to == "":
+        date_to = date_from
+    elif isinstance(date_to, str):
+        date_to = datetime.date.fromisoformat(date_to)
+
+    start = datetime.datetime.combine(date_from, datetime.time.min)
+    end = datetime.datetime.combine(date_to + datetime.timedelta(days=1), start.time())
+
+    return start, end
@@ -0,0 +1,225 @@
+import argparse
+import datetime
+import glob
+import logging
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+from database import dispose_engines, get_engine
+from utils import CHUNK_SIZE, get_creds, iter_offers_params_table
+
+APP_NAME = "otodom_export"
+
+TABLE_NAME = "otodom_offers_params"
+EXPORT_DIR = os.path.join("export", TABLE_NAME)
+
+# Arrow types of PostgreSQL columns, text goes dictionary-encoded
+ARROW_TYPES = {
+    "numeric": pa.float64(),
+    "double precision": pa.float64(),
+    "real": pa.float32(),
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "boolean": pa.bool_(),
+    "date": pa.date32(),
+    "timestamp without time zone": pa.timestamp("us"),
+    "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+}
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.date32())]), flavor="hive")
+
+
+def get_arrow_schema(conn, table_name=TABLE_NAME):
+    """
+    Arrow schema of table built from information_schema, so every
+    chunk and every day is written with the same types
+    """
+    query = """
+    select column_name, data_type
+    from information_schema.columns
+    where table_schema = 'public' and table_name = :table_name
+    order by ordinal_position
+    """
+
+    fields = list()
+    for column_name, data_type in conn.execute(text(query), {"table_name": table_name}):
+        arrow_type = ARROW_TYPES.get(data_type, pa.dictionary(pa.int32(), pa.string()))
+        fields.append(pa.field(column_name, arrow_type))
+
+    return pa.schema(fields)
+
+
+def to_arrow(df, schema):
+    """
+    Converts chunk read from DB into Arrow table of given schema
+    """
+    for field in schema:
+        # numeric columns come as Decimal objects
+        if pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+            df[field.name] = pd.to_numeric(df[field.name])
+
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False, safe=False)
+
+
+def exported_days(path=EXPORT_DIR):
+    """
+    Days already exported, one date=YYYY-MM-DD directory per day
+    """
+    days = list()
+    for day_dir in glob.glob(os.path.join(path, "date=*")):
+        days.append(datetime.date.fromisoformat(day_dir.rsplit("=", 1)[1]))
+
+    return sorted(days)
+
+
+def export_day(
+    logger, credentials, day, schema, path=EXPORT_DIR, chunk_size=CHUNK_SIZE
+):
+    """
+    Streams one day of offers params through server-side cursor in
+    chunks of chunk_size rows into date=YYYY-MM-DD/part-0.parquet.
+    Day is written into hidden directory first and renamed when
+    complete, so readers never see half-exported day
+    """
+    day_dir = os.path.join(path, f"date={day.isoformat()}")
+    tmp_dir = os.path.join(path, f".date={day.isoformat()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    chunks = iter_offers_params_table(
+        credentials,
+        date_from=day.isoformat(),
+        columns=schema.names,
+        chunk_size=chunk_size,
+    )
+
+    rows = 0
+    with pq.ParquetWriter(
+        os.path.join(tmp_dir, "part-0.parquet"), schema, compression="zstd"
+    ) as writer:
+        for df in chunks:
+            writer.write_table(to_arrow(df, schema))
+            rows += len(df)
+
+    shutil.rmtree(day_dir, ignore_errors=True)
+    os.rename(tmp_dir, day_dir)
+    logger.info(f"{rows} rows exported for {day}")
+
+    return rows
+
+
+def export_offers_params(
+    logger,
+    credentials,
+    date_from="",
+    date_to="",
+    path=EXPORT_DIR,
+    chunk_size=CHUNK_SIZE,
+    overwrite=False,
+):
+    """
+    Exports offers params into Parquet files partitioned by day.
+    Without date_from export continues from the day after the last
+    exported one (or the first day in DB), without date_to it stops
+    at yesterday. Days already exported are skipped unless overwrite
+    """
+    engine = get_engine(credentials)
+    done = set(exported_days(path))
+
+    if len(date_from) > 0:
+        date_from = datetime.date.fromisoformat(date_from)
+    elif done:
+        date_from = max(done) + datetime.timedelta(days=1)
+    else:
+        with engine.connect() as conn:
+            first_timestamp = conn.execute(
+                text(f"select min(create_timestamp) from public.{TABLE_NAME}")
+            ).scalar()
+        if first_timestamp is None:
+            logger.info("Nothing to export")
+            return
+        date_from = first_timestamp.date()
+
+    if len(date_to) > 0:
+        date_to = datetime.date.fromisoformat(date_to)
+    else:
+        date_to = datetime.date.today() - datetime.timedelta(days=1)
+
+    with engine.connect() as conn:
+        schema = get_arrow_schema(conn)
+
+    day = date_from
+    while day <= date_to:
+        if day in done and not overwrite:
+            logger.info(f"{day} already exported")
+        else:
+            export_day(logger, credentials, day, schema, path, chunk_size)
+        day += datetime.timedelta(days=1)
+
+
+def load_offers_params_parquet(path=EXPORT_DIR, columns=None, date_from="", date_to=""):
+    """
+    Reads exported offers params into DataFrame, only selected columns
+    and only partitions of days from date_from to date_to (inclusive)
+    """
+    dataset = ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+
+    condition = None
+    if len(date_from) > 0:
+        date_start = datetime.date.fromisoformat(date_from)
+        date_end = datetime.date.fromisoformat(date_to) if date_to else date_start
+        condition = (ds.field("date") >= date_start) & (ds.field("date") <= date_end)
+
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--date_from",
+        help="first day to export (default: after last exported)",
+        default="",
+    )
+    parser.add_argument(
+        "--date_to", help="last day to export (default: yesterday)", default=""
+    )
+    parser.add_argument("--path", help="export directory", default=EXPORT_DIR)
+    parser.add_argument(
+        "--chunk_size", help="rows read from DB at once", type=int, default=CHUNK_SIZE
+    )
+    parser.add_argument(
+        "--overwrite", help="export again days already exported", action="store_true"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
+    logger = logging.getLogger(APP_NAME)
+    logger.info(f"Starting {APP_NAME}")
+
+    export_offers_params(
+        logger,
+        get_creds(),
+        date_from=args.date_from,
+        date_to=args.date_to,
+        path=args.path,
+        chunk_size=args.chunk_size,
+        overwrite=args.overwrite,
+    )
+
+    dispose_engines()
+    logger.info(f"{APP_NAME} finished")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
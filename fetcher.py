@@ -0,0 +1,249 @@
+import asyncio
+import datetime
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+import metrics
+from http_client import create_async_session, fetch_page
+from parsers import DEFAULT_BACKEND, PARSER_VERSIONS
+from profiling import stop_inherited_profiling
+from rate_limiter import AdaptiveRateLimiter
+from response_cache import body_hash
+
+OFFER_URL = "https://www.otodom.pl/pl/oferta/{}"
+BATCH_SIZE = 1000
+# Offer ids taken from offer_ids at once in a thread, so that reading
+# them from database or checkpoint does not block the event loop
+IDS_CHUNK_SIZE = 100
+
+
+async def fetch_offers(
+    logger,
+    offer_ids,
+    parse,
+    save,
+    concurrency=8,
+    rate=1.0,
+    max_rate=None,
+    batch_size=BATCH_SIZE,
+    processes=None,
+    queue_size=None,
+    cache=None,
+    archive=None,
+    offer_url=OFFER_URL,
+    backend=DEFAULT_BACKEND,
+):
+    """
+    Pipeline of three stages connected with bounded queues: async
+    fetchers download offer pages, parse() runs in a pool of processes
+    and a single writer passes parsed offers to save() in batches of
+    batch_size. Full queues make fetchers wait for parsers and parsers
+    wait for writer. With processes=0 parse() runs in threads.
+    Request rate starts at rate and adapts to the site up to max_rate.
+    With cache offers are requested conditionally and params of pages
+    that did not change are taken from cache without parsing, if they
+    were parsed by the same backend (of parse()) and its version. With
+    archive raw pages are appended to it for later replay.
+    Offer pages are requested from offer_url with offer id inserted.
+    Offer ids and cache entries are read in threads, so that database
+    and SQLite reads do not block the event loop
+    """
+    if processes is None:
+        processes = os.cpu_count()
+
+    parsers_count = max(processes, 1) * 2
+    limiter = AdaptiveRateLimiter(rate, max_rate=max_rate, logger=logger)
+    parser_version = PARSER_VERSIONS.get(backend)
+    ids = iter(offer_ids)
+    ids_queue = asyncio.Queue(maxsize=IDS_CHUNK_SIZE)
+    pages = asyncio.Queue(maxsize=queue_size or parsers_count * 2)
+    batches = asyncio.Queue(maxsize=2)
+    results = list()
+    processed = 0
+    not_modified = 0
+
+    def count_processed():
+        nonlocal processed
+
+        processed += 1
+        metrics.inc("offers_processed_total")
+        if processed % 150 == 0:
+            logger.info(f"{processed} offers processed")
+
+    def next_ids():
+        return list(itertools.islice(ids, IDS_CHUNK_SIZE))
+
+    async def read_ids():
+        # Next chunk is read while fetchers take ids of the previous one
+        while chunk := await asyncio.to_thread(next_ids):
+            for offer_id in chunk:
+                await ids_queue.put(offer_id)
+
+        for _ in range(concurrency):
+            await ids_queue.put(None)
+
+    async def fetcher(session):
+        nonlocal not_modified
+
+        # Fetchers share one queue, so every offer id is taken exactly once
+        while (offer_id := await ids_queue.get()) is not None:
+            url = offer_url.format(offer_id)
+            entry = None
+            headers = None
+            if cache is not None:
+                entry = await asyncio.to_thread(cache.get, offer_id)
+                headers = cache.conditional_headers(entry)
+
+            try:
+                status, content, response_headers = await fetch_page(
+                    session, url, headers=headers, limiter=limiter
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Request failed: {url} ({e!r})")
+                metrics.inc("failed_requests_total")
+                count_processed()
+                continue
+
+            fetch_timestamp = datetime.datetime.now()
+
+            # Page did not change, its body and validators are in cache
+            if status == 304:
+                content = await asyncio.to_thread(cache.get_body, offer_id)
+                response_headers = {
+                    "ETag": entry["etag"],
+                    "Last-Modified": entry["last_modified"],
+                }
+
+            if archive is not None:
+                archive.append(offer_id, fetch_timestamp, content)
+
+            cached_params = None
+            if entry is not None and (
+                status == 304 or body_hash(content) == entry["body_hash"]
+            ):
+                not_modified += 1
+                metrics.inc("not_modified_total")
+
+                # Params parsed by other parser are parsed again
+                if (entry["parser"], entry["parser_version"]) == (
+                    backend,
+                    parser_version,
+                ):
+                    cached_params = entry["params"]
+
+            await pages.put(
+                (
+                    offer_id,
+                    fetch_timestamp,
+                    content,
+                    cached_params,
+                    response_headers,
+                )
+            )
+
+    async def parse_page(loop, executor, url, content):
+        # Includes time spent waiting for a free parser process
+        try:
+            with metrics.timer("parse_seconds"):
+                return await loop.run_in_executor(executor, parse, content)
+        except AttributeError:
+            logger.warning(f"Broken URL: {url}")
+            metrics.inc("broken_urls_total")
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"Parsing failed: {url} ({e!r})")
+            metrics.inc("parse_failures_total")
+
+    async def parser(executor):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            page = await pages.get()
+            if page is None:
+                break
+
+            offer_id, fetch_timestamp, content, offer_params, headers = page
+            url = offer_url.format(offer_id)
+
+            if offer_params is None:
+                offer_params = await parse_page(loop, executor, url, content)
+
+                if offer_params is not None and cache is not None:
+                    await asyncio.to_thread(
+                        cache.put,
+                        offer_id,
+                        content,
+                        offer_params,
+                        etag=headers.get("ETag"),
+                        last_modified=headers.get("Last-Modified"),
+                        parser=backend,
+                        parser_version=parser_version,
+                    )
+
+            if offer_params is not None:
+                offer = dict()
+                offer["create_timestamp"] = fetch_timestamp
+                offer["id"] = offer_id
+                offer = {**offer, **offer_params}
+                results.append(offer)
+
+            count_processed()
+
+            if len(results) >= batch_size:
+                await batches.put(take_results())
+
+    def take_results():
+        batch = results.copy()
+        results.clear()
+
+        return batch
+
+    async def writer():
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+
+            # Cache entries of saved offers are committed with them
+            if cache is not None:
+                await asyncio.to_thread(cache.commit)
+
+            await asyncio.to_thread(save, batch)
+
+    async def produce(session):
+        await asyncio.gather(
+            read_ids(), *(fetcher(session) for _ in range(concurrency))
+        )
+
+        for _ in range(parsers_count):
+            await pages.put(None)
+
+    async def consume(executor):
+        await asyncio.gather(*(parser(executor) for _ in range(parsers_count)))
+
+        if results:
+            await batches.put(take_results())
+        await batches.put(None)
+
+    executor = None
+    if processes > 0:
+        executor = ProcessPoolExecutor(
+            max_workers=processes, initializer=stop_inherited_profiling
+        )
+    try:
+        async with create_async_session(pool_size=concurrency) as session:
+            await asyncio.gather(produce(session), consume(executor), writer())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+        # Pages fetched since last batch stay cached also after errors
+        if cache is not None:
+            cache.commit()
+
+    logger.info(f"{processed} offers processed")
+
+    if cache is not None:
+        logger.info(f"{not_modified} offers not modified since cached")
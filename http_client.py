@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+POOL_SIZE = 16
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+KEEPALIVE_TIMEOUT = 60
+RETRIES = 3
+BACKOFF_FACTOR = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "pl-PL,pl;q=0.9,en;q=0.8",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+}
+
+_session = None
+
+
+def get_session(pool_size=POOL_SIZE):
+    """
+    Returns process wide requests session with keep-alive connection
+    pool and retries with backoff on 429/5xx responses
+    """
+    global _session
+
+    if _session is None:
+        retry = Retry(
+            total=RETRIES,
+            backoff_factor=BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=["GET", "HEAD"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+
+    return _session
+
+
+def get(url, **kwargs):
+    """
+    GET request through shared session with connect/read timeouts
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+
+    return get_session().get(url, **kwargs)
+
+
+def create_async_session(pool_size=POOL_SIZE):
+    """
+    Creates aiohttp session with the same headers, timeouts and
+    keep-alive connection pool as the requests session
+    """
+    connector = aiohttp.TCPConnector(
+        limit=pool_size, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=300
+    )
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+    )
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS)
+
+
+def retry_after_header(response):
+    """
+    Retry-After header in seconds, None if missing or not a number
+    """
+    header = response.headers.get("Retry-After") if response is not None else None
+
+    if header is not None and header.isdigit():
+        return int(header)
+
+
+def retry_after(response, attempt):
+    """
+    Seconds to wait before next attempt, Retry-After header wins
+    over exponential backoff
+    """
+    header = retry_after_header(response)
+
+    if header is not None:
+        return header
+
+    return BACKOFF_FACTOR * (2**attempt)
+
+
+async def fetch_page(session, url, headers=None, retries=RETRIES, limiter=None):
+    """
+    GET request through aiohttp session, retries with backoff on
+    429/5xx responses and connection errors. Returns status, body and
+    headers of response, 304 Not Modified is returned with empty body.
+    With limiter every attempt waits for it and reports status and
+    latency back to it
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            await limiter.acquire(url)
+
+        started = time.monotonic()
+        try:
+            with metrics.in_flight("requests_in_flight"):
+                async with session.get(url, headers=headers) as response:
+                    latency = time.monotonic() - started
+                    metrics.observe("request_seconds", latency)
+                    metrics.inc("responses_total", status=response.status)
+
+                    if limiter is not None:
+                        limiter.feedback(
+                            url, response.status, latency, retry_after_header(response)
+                        )
+
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        response.raise_for_status()
+                        body = await response.read()
+
+                        return response.status, body, response.headers.copy()
+
+                    wait = retry_after(response, attempt)
+
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            metrics.inc("request_errors_total")
+            if attempt == retries:
+                raise
+            wait = retry_after(None, attempt)
+
+        metrics.inc("retries_total")
+        await asyncio.sleep(wait)
+
+
+async def fetch(session, url, retries=RETRIES, limiter=None):
+    """
+    Same as fetch_page(), returns only response body
+    """
+    _, body, _ = await fetch_page(session, url, retries=retries, limiter=limiter)
+
+    return body
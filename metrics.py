@@ -0,0 +1,226 @@
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "otodom_"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = dict()
+_gauges = dict()
+_histograms = dict()
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like Prometheus histogram
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimates quantile by linear interpolation inside its bucket
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if seen + count >= rank and count > 0:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+
+        return self.buckets[-1]
+
+
+def key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Increases counter, e.g. inc("retries_total", status=429)
+    """
+    with _lock:
+        k = key(name, labels)
+        _counters[k] = _counters.get(k, 0) + value
+
+
+def value(name, **labels):
+    """
+    Current value of counter, 0 if never increased
+    """
+    with _lock:
+        return _counters.get(key(name, labels), 0)
+
+
+def gauge_add(name, value, **labels):
+    with _lock:
+        k = key(name, labels)
+        _gauges[k] = _gauges.get(k, 0) + value
+
+
+def observe(name, value, **labels):
+    with _lock:
+        k = key(name, labels)
+        if k not in _histograms:
+            _histograms[k] = Histogram()
+        _histograms[k].observe(value)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Observes time spent in with block in histogram name, also when
+    block raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextlib.contextmanager
+def in_flight(name, **labels):
+    """
+    Gauge of with blocks running at the moment
+    """
+    gauge_add(name, 1, **labels)
+    try:
+        yield
+    finally:
+        gauge_add(name, -1, **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render():
+    """
+    All metrics in Prometheus text exposition format
+    """
+    lines = list()
+    typed = set()
+
+    def add_type(name, kind):
+        # One TYPE line per metric, not per set of labels
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    with _lock:
+        for kind, metrics in [("counter", _counters), ("gauge", _gauges)]:
+            for (name, labels), value in sorted(metrics.items()):
+                add_type(name, kind)
+                lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(_histograms.items()):
+            add_type(name, "histogram")
+
+            cumulative = 0
+            bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                bucket_labels = format_labels(labels, [("le", bound)])
+                lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+
+            lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(
+                f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host="127.0.0.1"):
+    """
+    Serves metrics on http://host:port/metrics from daemon thread
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def summary():
+    """
+    Table of timings and counters of the run as list of lines
+    """
+    lines = list()
+
+    with _lock:
+        if _histograms:
+            lines.append(
+                f"{'stage':<40} {'count':>8} {'total s':>10} "
+                f"{'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}"
+            )
+            for (name, labels), histogram in sorted(_histograms.items()):
+                mean = histogram.sum / histogram.count * 1000
+                lines.append(
+                    f"{name + format_labels(labels):<40} {histogram.count:>8} "
+                    f"{histogram.sum:>10.2f} {mean:>10.1f} "
+                    f"{histogram.quantile(0.5) * 1000:>10.1f} "
+                    f"{histogram.quantile(0.99) * 1000:>10.1f}"
+                )
+
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"{name + format_labels(labels):<40} {value:>8}")
+
+    return lines
+
+
+def log_summary(logger):
+    for line in summary():
+        logger.info(f"[metrics] {line}")
@@ -0,0 +1,122 @@
+import hashlib
+import json
+
+import pandas as pd
+
+# First number in text like "612 000 zl", "57,5 m2" or "10+"
+NUMBER_PATTERN = r"(-?\d[\d ]*(?:[.,]\d+)?)"
+
+# Floors written as words, "> 10" is kept as 11
+FLOORS = {"suterena": -1, "parter": 0}
+
+# Raw text column, typed column and its dtype
+NUMERIC_COLUMNS = [
+    ("price", "price_pln", "float64"),
+    ("price_m2", "price_m2_pln", "float64"),
+    ("powierzchnia", "area_m2", "float64"),
+    ("liczba_pokoi", "rooms", "Int16"),
+]
+RAW_COLUMNS = [raw for raw, _, _ in NUMERIC_COLUMNS] + ["pietro"]
+
+# Currencies of price strings after unidecode ("zl", "EUR" for euro sign),
+# numbers of PRICE_COLUMNS are kept only for prices in PLN
+CURRENCY_PATTERN = r"(zl|pln|eur|usd|\$)"
+CURRENCIES = {"zl": "PLN", "pln": "PLN", "eur": "EUR", "usd": "USD", "$": "USD"}
+PRICE_COLUMNS = ["price", "price_m2"]
+
+# Columns describing scrape, not offer, left out of params hash
+NOT_HASHED_COLUMNS = ["id", "create_timestamp"]
+
+
+def to_numbers(values):
+    """
+    Extracts first number from every string of Series at once
+    """
+    numbers = values.astype("string").str.extract(NUMBER_PATTERN, expand=False)
+    numbers = numbers.str.replace(" ", "", regex=False).str.replace(
+        ",", ".", regex=False
+    )
+
+    return pd.to_numeric(numbers, errors="coerce")
+
+
+def to_currencies(values):
+    """
+    Currency code of every price string, missing when string has none
+    """
+    currencies = values.astype("string").str.lower()
+    currencies = currencies.str.extract(CURRENCY_PATTERN, expand=False)
+
+    return currencies.map(CURRENCIES, na_action="ignore").astype("string")
+
+
+def to_floors(values):
+    """
+    Splits "pietro" strings like "2/4", "parter/4" or "> 10/12"
+    into floor and number of floors in building
+    """
+    parts = values.astype("string").str.split("/", n=1)
+    floor = parts.str[0].str.strip()
+
+    floor_number = to_numbers(floor)
+    floor_number = floor_number.where(
+        ~floor.str.startswith(">", na=False), floor_number + 1
+    )
+    floor_number = floor_number.fillna(floor.map(FLOORS))
+
+    return floor_number.astype("Int16"), to_numbers(parts.str[1]).astype("Int16")
+
+
+def normalize_offers(offers, keep_raw=False):
+    """
+    Converts batch of parsed offers into DataFrame with price, price per
+    m2, area, rooms and floor as numbers. Numbers already given by parser
+    (json backend) are kept. Currency of price is saved in currency
+    column, prices in other currencies than PLN are left empty. Raw text
+    columns are dropped unless keep_raw
+    """
+    df = pd.DataFrame.from_records(offers)
+
+    if "price" in df:
+        df["currency"] = to_currencies(df["price"])
+
+    for raw, column, dtype in NUMERIC_COLUMNS:
+        if raw not in df:
+            continue
+
+        numbers = to_numbers(df[raw])
+        if column in df:
+            numbers = pd.to_numeric(df[column], errors="coerce").fillna(numbers)
+
+        if raw in PRICE_COLUMNS:
+            # Strings without currency are taken as PLN
+            in_pln = to_currencies(df[raw]).fillna("PLN").eq("PLN")
+            numbers = numbers.where(in_pln.astype(bool))
+
+        df[column] = numbers.astype(dtype)
+
+    if "pietro" in df:
+        df["floor"], df["floors_total"] = to_floors(df["pietro"])
+
+    if not keep_raw:
+        df = df.drop(columns=[raw for raw in RAW_COLUMNS if raw in df])
+
+    return df
+
+
+def hash_params(df):
+    """
+    Stable hash of every offer params, equal for offers with the same
+    values whatever the order of columns. Missing values are left out,
+    so new empty columns do not change hashes
+    """
+    params = df.drop(columns=[c for c in NOT_HASHED_COLUMNS if c in df])
+    params = params.astype(object).where(params.notna(), None)
+
+    hashes = list()
+    for record in params.to_dict("records"):
+        record = {k: v for k, v in record.items() if v is not None}
+        encoded = json.dumps(record, sort_keys=True, default=str).encode("utf-8")
+        hashes.append(hashlib.sha256(encoded).hexdigest())
+
+    return pd.Series(hashes, index=df.index, dtype=object)
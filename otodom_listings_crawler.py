@@ -1,11 +1,17 @@
 import argparse
+import asyncio
 import datetime
+import functools
 import logging
+import math
 import os
 import re
 import sys
 import time
 import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import pandas as pd
 from bs4 import BeautifulSoup
@@ -15,29 +21,148 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
-from sqlalchemy import create_engine
 
+import metrics
+from browser_pool import MAX_PAGES, BrowserPool
+from bulk_writer import copy_rows
+from checkpoint import RunState
+from database import dispose_engines, get_engine
+from http_client import create_async_session, fetch
+from parsers import get_next_data, get_offers_ids
+from profiling import PROFILERS, profile
+from rate_limiter import AdaptiveRateLimiter
 from utils import get_creds
 
 APP_NAME = "otodom_listing_crawler"
 CHROMEDRIVER_PATH = "/usr/local/bin/chromedriver"
 
-
-def crawler(logger, driver, actions, url, wait=5, dry_run=False):
+# Lean browser profile: offer ids are read from HTML, nothing else is needed
+BLOCKED_URLS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.webp",
+    "*.avif",
+    "*.svg",
+    "*.ico",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*.mp4",
+    "*.webm",
+    "*cookielaw.org*",
+    "*onetrust.com*",
+    "*googletagmanager.com*",
+    "*google-analytics.com*",
+    "*doubleclick.net*",
+    "*googlesyndication.com*",
+    "*facebook.net*",
+    "*hotjar.com*",
+    "*ninjacat.io*",
+]
+IMAGES_DISABLED = {"profile.managed_default_content_settings.images": 2}
+CONSENT_COOKIE = "OptanonAlertBoxClosed"
+CONSENT_DOMAIN = ".otodom.pl"
+# Default wait between listing pages in seconds
+WAIT = 5
+# Times page that timed out is opened again before listing is given up
+MAX_PAGE_RETRIES = 3
+
+
+def crawler(
+    logger,
+    driver,
+    actions,
+    url,
+    wait=WAIT,
+    dry_run=False,
+    upsert=False,
+    run_state=None,
+    start_page=1,
+    limiter=None,
+    browser=None,
+):
     """
     Crawls otodom listing to do some actions and
-    use pagination till its end
+    use pagination till its end, starting from start_page.
+    Pages are paced by adaptive limiter starting at 1/wait pages/s.
+    Page that timed out is opened again, up to MAX_PAGE_RETRIES times.
+    With pooled browser driver is recycled every few pages
     """
-    driver.get(url)  # open URL in Browser
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(1 / wait if wait > 0 else 0, logger=logger)
+
+    page = start_page
+    retries = 0
+    while page is not None:
+        next_page, timed_out = crawl_pages(
+            logger,
+            driver,
+            actions,
+            url,
+            wait,
+            dry_run,
+            upsert,
+            run_state,
+            page,
+            limiter,
+            browser,
+        )
 
-    # Cookies
-    try:
-        logger.info("Accepting cookies")
-        driver.find_element(
-            By.ID, "onetrust-accept-btn-handler"
-        ).click()  # accept cookies
-    except NoSuchElementException:
-        logger.info("Cookies already accepted")
+        if timed_out:
+            retries = retries + 1 if next_page == page else 1
+            if retries > MAX_PAGE_RETRIES:
+                raise TimeoutException(
+                    f"Page {next_page} of {url} timed out {retries} times"
+                )
+        else:
+            retries = 0
+
+        # Fresh browser continues from the next page
+        if browser is not None and browser.driver is not driver:
+            driver = browser.driver
+            actions = ActionChains(driver)
+
+        page = next_page
+
+
+def crawl_pages(
+    logger,
+    driver,
+    actions,
+    url,
+    wait,
+    dry_run,
+    upsert,
+    run_state,
+    start_page,
+    limiter,
+    browser,
+):
+    """
+    Crawls listing pages from start_page with one driver, returns page
+    to continue from (None when listing is done) and whether it timed out
+    """
+    limiter.wait(url)
+    requested = time.monotonic()
+
+    if start_page > 1:
+        logger.info(f"Starting from page {start_page}")
+        driver.get(get_listing_page_url(url, start_page))
+    else:
+        driver.get(url)  # open URL in Browser
+
+    # Cookies, consent cookie is already set by lean browser profile
+    if driver.get_cookie(CONSENT_COOKIE) is None:
+        try:
+            logger.info("Accepting cookies")
+            driver.find_element(
+                By.ID, "onetrust-accept-btn-handler"
+            ).click()  # accept cookies
+        except NoSuchElementException:
+            logger.info("Cookies already accepted")
 
     pagination_button = driver.find_element(
         By.XPATH, "//*[@data-cy='pagination.next-page']"
@@ -57,7 +182,8 @@ def crawler(logger, driver, actions, url, wait=5, dry_run=False):
     logger.info(f"Estimated runtime {runtime_timedelta}")
 
     if dry_run is False:
-        for i in range(0, total_pages_number):
+        for i in range(start_page - 1, total_pages_number):
+            page = i + 1
             logger.info(f"Current URL: {driver.current_url}")
 
             # Move to pagination button
@@ -68,16 +194,20 @@ def crawler(logger, driver, actions, url, wait=5, dry_run=False):
                 actions.move_to_element(pagination_button).perform()
             except TimeoutException as e:
                 logger.error(e)
-                logger.error(logger.error(traceback.format_exc()))
+                logger.error(traceback.format_exc())
 
-                time.sleep(30)
-                crawler(logger, driver, actions, driver.current_url, wait, dry_run)
+                # Slow down and start over from the page that timed out
+                limiter.feedback(url, 503, time.monotonic() - requested, 30)
+                return page, True
+
+            limiter.feedback(url, 200, time.monotonic() - requested)
 
             # Get page source
             html = driver.page_source
 
             # Get offers ids
-            offers_ids = get_offers_ids(html)
+            with metrics.timer("get_offers_ids_seconds"):
+                offers_ids = get_offers_ids(html)
 
             # Creatinfg df with offers ids
             df = pd.DataFrame(offers_ids, columns=["offer_id"])
@@ -85,43 +215,154 @@ def crawler(logger, driver, actions, url, wait=5, dry_run=False):
             df.insert(loc=1, column="listing_url", value=driver.current_url)
 
             # Saving to DB
-            save_df(logger, df, get_creds(), csv=False, db=True)
+            save_df(logger, df, get_creds(), csv=False, db=True, upsert=upsert)
+            metrics.inc("listing_pages_total")
+
+            if run_state is not None:
+                run_state.mark_page_done(url, page)
 
             del offers_ids, df
 
+            if not pagination_button.is_enabled():
+                break
+
+            # Fresh browser continues from the next page
+            if browser is not None and browser.count_page():
+                browser.restart()
+                return page + 1, False
+
             # Wait and go to the next page
-            time.sleep(wait)
+            limiter.wait(url)
 
-            if pagination_button.is_enabled():
-                pagination_button.click()
-            else:
-                break
+            requested = time.monotonic()
+            pagination_button.click()
+
+    return None, False
+
+
+def get_listing_page_url(url, page):
+    """
+    Sets page query param of otodom listing URL
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = [(k, v) for k, v in parse_qsl(query) if k != "page"]
+    params.append(("page", str(page)))
+
+    return urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+
+
+def get_listing_data(page_source):
+    """
+    Takes otodom listing page and get offer ids and total pages number
+    from __NEXT_DATA__ JSON embedded in that page
+    """
+    page_props = get_next_data(page_source)["props"]["pageProps"]
 
+    search_ads = page_props.get("data", {}).get("searchAds")
+    if search_ads is not None:
+        offer_ids = [item["slug"] for item in search_ads["items"]]
 
-def get_offers_ids(page_source):
+        pagination = search_ads["pagination"]
+        total_pages = pagination.get("totalPages") or math.ceil(
+            pagination["totalItems"] / pagination["itemsPerPage"]
+        )
+        return offer_ids, max(total_pages, 1)
+
+    # Older listing pages only carry offers in schema.org markup
+    offers = page_props["schemaMarkupData"]["@graph"][2]["offers"]["offers"]
+    offer_ids = [offer["url"].rstrip("/").split("/")[-1] for offer in offers]
+
+    return offer_ids, 1
+
+
+async def http_crawler(
+    logger,
+    url,
+    wait=WAIT,
+    concurrency=4,
+    dry_run=False,
+    upsert=False,
+    run_state=None,
+    save=None,
+    limiter=None,
+):
     """
-    Takes otodom listing page and get all offer ids from that page
+    Crawls otodom listing without browser, requests ?page=N URLs
+    directly and reads offer ids from __NEXT_DATA__ JSON. Pages already
+    done in run_state are skipped. Offer ids are saved with save_df()
+    or save(), if given. Requests are paced by limiter, shared by all
+    listings of the run, or by own one starting at 1/wait pages/s
     """
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(1 / wait if wait > 0 else 0, logger=logger)
+    saves = list()
+    done_pages = run_state.done_pages(url) if run_state is not None else set()
+
+    def save_and_mark(df, page):
+        if save is not None:
+            save(df)
+        else:
+            save_df(logger, df, get_creds(), csv=False, db=True, upsert=upsert)
+
+        if run_state is not None:
+            run_state.mark_page_done(url, page)
+
+    def save_page(page, page_url, offers_ids):
+        # Creatinfg df with offers ids
+        df = pd.DataFrame(offers_ids, columns=["offer_id"])
+        df.insert(loc=0, column="create_timestamp", value=datetime.datetime.now())
+        df.insert(loc=1, column="listing_url", value=page_url)
+
+        # Saving to DB
+        saves.append(asyncio.ensure_future(asyncio.to_thread(save_and_mark, df, page)))
+        metrics.inc("listing_pages_total")
+
+    async def get_page(session, page):
+        page_url = get_listing_page_url(url, page)
+
+        logger.info(f"Current URL: {page_url}")
+        content = await fetch(session, page_url, limiter=limiter)
 
-    soup = BeautifulSoup(page_source, "html.parser")
+        with metrics.timer("get_listing_data_seconds"):
+            offers_ids, total_pages_number = get_listing_data(content)
 
-    listing_items = soup.find_all("li", {"data-cy": "listing-item"})
+        return page_url, offers_ids, total_pages_number
 
-    offer_urls = []
-    for item in listing_items:
-        a = item.find("a", {"data-cy": "listing-item-link"})
-        href_array = a["href"].split("/")
+    async with create_async_session(pool_size=concurrency) as session:
+        # First page tells how many pages there are
+        page_url, offers_ids, total_pages_number = await get_page(session, 1)
 
-        offer_id = href_array[len(href_array) - 1]
+        logger.info(f"Total pages: {total_pages_number}")
 
-        offer_urls.append(offer_id)
+        runtime_timedelta = datetime.timedelta(seconds=(total_pages_number * wait))
+        logger.info(f"Estimated runtime {runtime_timedelta}")
 
-    return offer_urls
+        if dry_run is False:
+            if 1 not in done_pages:
+                save_page(1, page_url, offers_ids)
 
+            pages = iter(range(2, total_pages_number + 1))
 
-def save_df(logger, df, credentials, csv=True, db=True):
+            async def worker():
+                for page in pages:
+                    if page in done_pages:
+                        continue
+
+                    try:
+                        page_url, offers_ids, _ = await get_page(session, page)
+                        save_page(page, page_url, offers_ids)
+                    except Exception as e:
+                        logger.error(f"Page {page} failed: {e!r}")
+                        metrics.inc("failed_pages_total")
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            await asyncio.gather(*saves)
+
+
+def save_df(logger, df, credentials, csv=True, db=True, upsert=False):
     """
-    Saves otodom offer ids into CSV or/and DB table
+    Saves otodom offer ids into CSV or/and DB table, DB rows
+    are streamed with COPY
     """
     # Save to CSV
     if csv:
@@ -132,13 +373,18 @@ def save_df(logger, df, credentials, csv=True, db=True):
     # Save to DB
     if db:
         # Saving to PostgreSQL DB
-        engine = create_engine(
-            f"postgresql://{credentials['username']}:{credentials['password']}"
-            f"@{credentials['host']}:{credentials['port']}/{credentials['database']}"
-        )
+        engine = get_engine(credentials)
 
         table_name = "otodom_offers_ids"
-        df.to_sql(table_name, engine, if_exists="append", index=False)
+        with metrics.timer("save_df_seconds"):
+            copy_rows(
+                engine,
+                table_name,
+                list(df.columns),
+                df.itertuples(index=False, name=None),
+                upsert_keys=["offer_id"] if upsert else None,
+            )
+        metrics.inc("offer_ids_saved_total", len(df))
         logger.info(
             f"Results saved to PostgreSQL DB into table: {credentials['database']}.{table_name}"
         )
@@ -146,7 +392,7 @@ def save_df(logger, df, credentials, csv=True, db=True):
 
 def get_get_listings_from_file(logger, file_path):
     """
-    Gets listings from file, remove new line symbol at the end of each line 
+    Gets listings from file, remove new line symbol at the end of each line
     """
     try:
         with open(file_path) as f:
@@ -158,51 +404,130 @@ def get_get_listings_from_file(logger, file_path):
     return listings_without_n
 
 
-def do_single_listing(logger, listing_url, run, wait, dry_run):
-    logger.info(f"[listing] {listing_url}")
+def parse_shard(shard):
+    """
+    Parses shard given as "i/n" into (i, n), shards are numbered from 0
+    """
+    index, count = [int(part) for part in shard.split("/")]
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Incorrect shard {shard}, should be i/n with 0 <= i < n")
+
+    return index, count
+
+
+def get_shard_listings(listings, index, count):
+    """
+    Listings of shard index out of count shards. Listing goes to shard
+    by CRC32 of its URL, so every machine splits file the same way
+    """
+    return [
+        listing
+        for listing in listings
+        if zlib.crc32(listing.encode("utf-8")) % count == index
+    ]
+
+
+def create_driver(run, lean=True):
+    """
+    Starts Chrome for local or server run. Lean browser does not wait
+    for full page load, does not download images, fonts, media and
+    trackers and starts with cookie consent already given
+    """
+    options = Options()
+
+    if lean:
+        options.page_load_strategy = "eager"
+        options.add_experimental_option("prefs", IMAGES_DISABLED)
 
     if run == "local":
-        driver = webdriver.Chrome()
+        driver = webdriver.Chrome(options=options)
 
     if run == "server":
         service = Service(CHROMEDRIVER_PATH)
 
-        options = Options()
         options.add_argument("--headless")
         options.add_argument("--window-size=%s" % "1920,1080")
         options.add_argument("--no-sandbox")
 
         driver = webdriver.Chrome(service=service, options=options)
 
-    actions = ActionChains(driver)
+    if lean:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+        driver.execute_cdp_cmd(
+            "Network.setCookie",
+            {
+                "name": CONSENT_COOKIE,
+                "value": datetime.datetime.utcnow().isoformat(timespec="seconds"),
+                "domain": CONSENT_DOMAIN,
+                "path": "/",
+            },
+        )
+
+    return driver
+
+
+def do_single_listing(
+    logger,
+    listing_url,
+    mode,
+    run,
+    wait,
+    concurrency,
+    dry_run,
+    upsert=False,
+    run_state=None,
+    pool=None,
+    lean=True,
+    limiter=None,
+):
+    logger.info(f"[listing] {listing_url}")
 
     if dry_run is None:
         dry_run = False
     else:
         logger.info(f"Dry run {dry_run}")
 
+    kwargs = dict(
+        logger=logger,
+        url=listing_url,
+        dry_run=dry_run,
+        upsert=upsert,
+        run_state=run_state,
+        limiter=limiter,
+    )
+
     if wait and isinstance(int(wait), int):
-        wait = int(wait)
-        logger.info(f"Wait between listing pages {wait}s")
-        crawler(
-            logger=logger,
-            driver=driver,
-            actions=actions,
-            url=listing_url,
-            wait=wait,
-            dry_run=dry_run,
-        )
+        kwargs["wait"] = int(wait)
+        logger.info(f"Wait between listing pages {kwargs['wait']}s")
     else:
         logger.info("Default wait time between listing pages")
-        crawler(
-            logger=logger,
-            driver=driver,
-            actions=actions,
-            url=listing_url,
-            dry_run=dry_run,
-        )
 
-    del driver, actions
+    if mode == "http":
+        asyncio.run(http_crawler(concurrency=concurrency, **kwargs))
+        return
+
+    start_page = 1
+    if run_state is not None:
+        start_page = run_state.last_page(listing_url) + 1
+
+    # Single listing gets its own pool of one browser
+    own_pool = pool is None
+    if own_pool:
+        pool = BrowserPool(functools.partial(create_driver, run, lean), logger=logger)
+
+    try:
+        with pool.browser() as browser:
+            crawler(
+                driver=browser.driver,
+                actions=ActionChains(browser.driver),
+                start_page=start_page,
+                browser=browser,
+                **kwargs,
+            )
+    finally:
+        if own_pool:
+            pool.close()
 
 
 def main(argv):
@@ -212,9 +537,76 @@ def main(argv):
     group.add_argument("--file", help="file with otodom listing(s) URL(s)")
     parser.add_argument("--wait", help="wait time between listing pages in seconds")
     parser.add_argument(
-        "--run", help="local/server", nargs="?", const="local", type=str, required=True
+        "--mode",
+        help="http (default) or selenium",
+        choices=["http", "selenium"],
+        default="http",
+    )
+    parser.add_argument(
+        "--run",
+        help="local/server, selenium mode only",
+        nargs="?",
+        const="local",
+        type=str,
+        default="local",
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="listing pages fetched at once, http mode only",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--workers",
+        help="listings from file crawled at once (default: 1, selenium: --browsers)",
+        type=int,
+    )
+    parser.add_argument(
+        "--shard",
+        help="crawl only shard i/n of listings from file, shards numbered from 0",
+        type=parse_shard,
+    )
+    parser.add_argument(
+        "--browsers",
+        help="browsers crawling listings from file at once, selenium mode only",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max_pages",
+        help="pages loaded by browser before it is restarted, selenium mode only",
+        type=int,
+        default=MAX_PAGES,
+    )
+    parser.add_argument(
+        "--browser_profile",
+        help="lean skips images, fonts, media and trackers, selenium mode only",
+        choices=["lean", "full"],
+        default="lean",
     )
     parser.add_argument("--dry_run", help="dry run", nargs="?", const=True, type=bool)
+    parser.add_argument(
+        "--upsert", help="replace offer ids already saved that day", action="store_true"
+    )
+    parser.add_argument(
+        "--resume", help="continue previous run from checkpoint", action="store_true"
+    )
+    parser.add_argument(
+        "--metrics_port", help="serve metrics on localhost:PORT/metrics", type=int
+    )
+    parser.add_argument(
+        "--profile",
+        help="profile run, stacks and top allocations go into logs/",
+        nargs="?",
+        choices=PROFILERS,
+        const="sample",
+    )
+    parser.add_argument(
+        "--profile_items",
+        help="listing pages crawled while allocations are traced",
+        type=int,
+        default=100,
+    )
     args = parser.parse_args()
 
     run_type = args.run
@@ -239,36 +631,101 @@ def main(argv):
 
     logger = logging.getLogger(APP_NAME)
 
-    logger.info(f"Starting {APP_NAME} run {run_type}")
+    logger.info(f"Starting {APP_NAME} run {run_type} mode {args.mode}")
+
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+        logger.info(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
 
+    mode = args.mode
     run = args.run
+    concurrency = args.concurrency
     wait = args.wait
     dry_run = args.dry_run
+    upsert = args.upsert
 
-    if args.listing:
-        listing_url = args.listing
+    run_id = f"{APP_NAME}:{args.listing or args.file}"
+    if args.shard:
+        run_id = f"{run_id}:{args.shard[0]}/{args.shard[1]}"
+
+    run_state = RunState(run_id)
+    if args.resume:
+        logger.info(f"Resuming run {run_state.run_id}")
+    else:
+        run_state.reset()
+
+    # One politeness budget for all workers, learned rate is kept
+    # between listings
+    page_wait = int(wait) if wait else WAIT
+    limiter = AdaptiveRateLimiter(1 / page_wait if page_wait > 0 else 0, logger=logger)
+
+    pool = None
+    if mode == "selenium":
+        pool = BrowserPool(
+            functools.partial(create_driver, run, args.browser_profile == "lean"),
+            size=args.browsers,
+            max_pages=args.max_pages,
+            logger=logger,
+        )
+
+    def listing_task(listing_url):
         try:
-            do_single_listing(logger, listing_url, run, wait, dry_run)
+            do_single_listing(
+                logger,
+                listing_url,
+                mode,
+                run,
+                wait,
+                concurrency,
+                dry_run,
+                upsert,
+                run_state,
+                pool,
+                limiter=limiter,
+            )
         except Exception as e:
             logger.error(e)
             logger.error(traceback.format_exc())
 
-    if args.file:
-        listing_file = args.file
-        logger.info(f"[file] {listing_file}")
-
-        listings = get_get_listings_from_file(logger, listing_file)
-        listings_count = len(listings)
-        logger.info(f"{listings_count} listings found in file")
-
-        for listing_url in listings:
-            try:
-                do_single_listing(logger, listing_url, run, wait, dry_run)
-            except Exception as e:
-                logger.error(e)
-                logger.error(traceback.format_exc())
-
-        logger.info(f"{APP_NAME} finished")
+    with profile(
+        logger, APP_NAME, args.profile, "listing_pages_total", args.profile_items
+    ):
+        try:
+            if args.listing:
+                listing_task(args.listing)
+
+            if args.file:
+                listing_file = args.file
+                logger.info(f"[file] {listing_file}")
+
+                listings = get_get_listings_from_file(logger, listing_file)
+                listings_count = len(listings)
+                logger.info(f"{listings_count} listings found in file")
+
+                if args.shard:
+                    shard_index, shard_count = args.shard
+                    listings = get_shard_listings(listings, shard_index, shard_count)
+                    logger.info(
+                        f"{len(listings)} listings in shard {shard_index}/{shard_count}"
+                    )
+
+                # Selenium workers wait for a free browser of the pool
+                workers = args.workers
+                if workers is None:
+                    workers = args.browsers if pool is not None else 1
+
+                logger.info(f"Crawling listings with {workers} workers")
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(listing_task, listings))
+
+                logger.info(f"{APP_NAME} finished")
+        finally:
+            if pool is not None:
+                pool.close()
+
+    run_state.close()
+    dispose_engines()
+    metrics.log_summary(logger)
 
 
 if __name__ == "__main__":
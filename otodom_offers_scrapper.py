@@ -1,140 +1,326 @@
 import argparse
+import asyncio
 import datetime
+import functools
 import logging
 import os
 import sys
-import time
 
-import pandas as pd
-import requests
-import unidecode
-from bs4 import BeautifulSoup
-from sqlalchemy import create_engine, text
-
-from utils import get_creds
+from sqlalchemy import text
+
+import http_client
+import metrics
+from archive import ARCHIVE_DIR, HtmlArchive, replay
+from bulk_writer import copy_dataframe, copy_versions, dataframe_rows
+from checkpoint import RunState
+from database import day_range, dispose_engines, get_engine
+from fetcher import BATCH_SIZE, OFFER_URL, fetch_offers
+from normalize import hash_params, normalize_offers
+from parsers import DEFAULT_BACKEND, OFFER_PARSERS, parse_offer_params
+from profiling import PROFILERS, profile
+from response_cache import CACHE_PATH, ResponseCache
+from schema import HISTORY_TABLE
+from utils import CHUNK_SIZE, get_creds
 
 APP_NAME = "otodom_offers_scrapper"
+STORES = ["params", "history", "both"]
+# Last scraped time of offers never scraped, sorts before any other
+NEVER_SCRAPED = datetime.datetime(1970, 1, 1)
 
 
-def get_offer_ids_from_db(logger, credentials, dt):
+def offer_ids_query(dt, ttl=None, new_first=False):
     """
-    Connects with PostgreSQl DB and get offer ids for selected day
+    Query of offer ids for selected day with its params. With ttl
+    (hours) offers scraped within last ttl hours are skipped. With ttl
+    or new_first last_scraped of every offer is selected too, offers
+    never scraped get NEVER_SCRAPED
     """
+    day_start, day_end = day_range(dt)
+    params = dict(day_start=day_start, day_end=day_end)
+    incremental = ttl is not None or new_first
+
+    if incremental:
+        query = """
+        select i.offer_id, coalesce(p.last_scraped, :never_scraped) as last_scraped
+        from (
+            select distinct offer_id
+            from public.otodom_offers_ids
+            where create_timestamp >= :day_start and create_timestamp < :day_end
+        ) i
+        left join lateral (
+            select max(p.create_timestamp) as last_scraped
+            from public.otodom_offers_params p
+            where p.id = i.offer_id
+        ) p on true
+        where 1=1
+        """
+        params["never_scraped"] = NEVER_SCRAPED
+
+        if ttl is not None:
+            query = (
+                f"{query} and (p.last_scraped is null"
+                " or p.last_scraped < :scraped_before)"
+            )
+            ttl_timedelta = datetime.timedelta(hours=ttl)
+            params["scraped_before"] = datetime.datetime.now() - ttl_timedelta
+    else:
+        query = """
+        select distinct offer_id
+        from public.otodom_offers_ids
+        where create_timestamp >= :day_start and create_timestamp < :day_end
+        """
 
-    engine = create_engine(
-        f"postgresql://{credentials['username']}:{credentials['password']}"
-        f"@{credentials['host']}:{credentials['port']}/{credentials['database']}"
-    )
+    return query, params
 
-    logger.info("Getting offers from database")
 
-    query = f"""
-    select distinct offer_id
-    from public.otodom_offers_ids
-    where date(create_timestamp) = '{dt}'
+def count_offer_ids_from_db(logger, credentials, dt, ttl=None, new_first=False):
+    """
+    Connects with PostgreSQl DB and counts offer ids for selected day,
+    without fetching them
     """
+    engine = get_engine(credentials)
+
+    query, params = offer_ids_query(dt, ttl, new_first)
+    query = f"select count(*) from ({query}) q"
 
     with engine.connect() as conn:
-        result = conn.execute(text(query)) 
-        offer_ids = [item[0] for item in result]
+        offer_ids_count = conn.execute(text(query), params).scalar()
 
-    logger.info(f"{len(offer_ids)} offers in database for {dt}")
+    if ttl is not None:
+        logger.info(f"{offer_ids_count} offers not scraped within last {ttl}h for {dt}")
+    else:
+        logger.info(f"{offer_ids_count} offers in database for {dt}")
 
-    return offer_ids
+    return offer_ids_count
 
 
-def get_offer_params(offer_url):
+def iter_offer_ids_from_db(
+    logger, credentials, dt, ttl=None, new_first=False, chunk_size=CHUNK_SIZE
+):
     """
-    Gets offer params by offer ID
+    Connects with PostgreSQl DB and yields offer ids for selected day,
+    read in pages of chunk_size ids with keyset pagination. Every page
+    is read in its own short transaction, so no connection or snapshot
+    is held during the run and memory use does not depend on number
+    of offers. With new_first offers never scraped before go first,
+    then the ones scraped longest ago, offers scraped after the first
+    page was read are not yielded again
     """
-    r = requests.get(offer_url)
-    soup = BeautifulSoup(r.content, "html.parser")
+    engine = get_engine(credentials)
 
-    offer_params = soup.find_all("div", {"class": "css-1wi2w6s enb64yk4"})
+    logger.info("Getting offers from database")
 
-    results = dict()
+    query, params = offer_ids_query(dt, ttl, new_first)
+    params["limit"] = chunk_size
+
+    if new_first:
+        query = f"""
+        select offer_id, last_scraped
+        from ({query}) q
+        where (last_scraped, offer_id) > (:last_scraped, :last_id)
+        and last_scraped < :started
+        order by last_scraped, offer_id
+        limit :limit
+        """
+        params["started"] = datetime.datetime.now()
+        params["last_scraped"] = NEVER_SCRAPED
+    else:
+        query = f"""
+        select offer_id
+        from ({query}) q
+        where offer_id > :last_id
+        order by offer_id
+        limit :limit
+        """
+    params["last_id"] = ""
 
-    price = soup.find("strong", {"aria-label": "Cena"}).get_text()
-    results["price"] = unidecode.unidecode(price)
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(text(query), params).all()
 
-    price_m2 = soup.find("div", {"aria-label": "Cena za metr kwadratowy"}).get_text()
-    results["price_m2"] = unidecode.unidecode(price_m2)
+        yield from (row[0] for row in rows)
 
-    address = soup.find("a", {"aria-label": "Adres"}).get_text()
-    results["address"] = unidecode.unidecode(address)
+        if len(rows) < chunk_size:
+            break
 
-    for line in offer_params:
-        k = unidecode.unidecode(
-            str(line.parent.parent["aria-label"])
-            .replace(" / ", "_")
-            .replace(" ", "_")
-            .lower()
-        )
-        v = unidecode.unidecode(str(line.get_text()).strip())
-        results[k] = v
+        params["last_id"] = rows[-1][0]
+        if new_first:
+            params["last_scraped"] = rows[-1][1]
 
-    return results
 
+def get_offer_params(offer_url, backend=DEFAULT_BACKEND):
+    """
+    Gets offer params by offer ID
+    """
+    with metrics.timer("get_offer_params_seconds"):
+        r = http_client.get(offer_url)
 
-def save_offers_params_to_db(logger, df, credentials):
-    engine = create_engine(
-        f"postgresql://{credentials['username']}:{credentials['password']}"
-        f"@{credentials['host']}:{credentials['port']}/{credentials['database']}"
-    )
-    table_name = "otodom_offers_params"
+        return parse_offer_params(r.content, backend)
+
+
+def save_offers_history_to_db(logger, df, credentials):
+    """
+    Saves normalised offers into offers history, only offers new or
+    changed since their last version, compared by hash of their params
+    """
+    engine = get_engine(credentials)
+
+    df = df.drop_duplicates("id", keep="last").copy()
+    df["params_hash"] = hash_params(df)
+    df["valid_from"] = df["create_timestamp"]
+
+    with metrics.timer("save_offers_history_seconds"):
+        changed = copy_versions(
+            engine, HISTORY_TABLE, list(df.columns), dataframe_rows(df)
+        )
 
     logger.info(
-        f"Saving {len(df.index)} rows into table: "
-        f"{credentials['database']}.{table_name}"
+        f"{changed} of {len(df)} offers changed, saved into table: "
+        f"{credentials['database']}.{HISTORY_TABLE}"
     )
-    df.to_sql(table_name, engine, if_exists="append", index=False)
+    metrics.inc("offers_changed_total", changed)
+
+
+def save_offers_params_to_db(
+    logger, offers, credentials, upsert=False, keep_raw=False, store="params"
+):
+    """
+    Saves list of offer params dicts into DB table with COPY, with
+    upsert offers already saved on the same day are replaced.
+    Prices, area, rooms and floor are saved as numbers, their raw
+    strings only with keep_raw. With store "history" only changes are
+    saved into offers history, with "both" into both tables
+    """
+    engine = get_engine(credentials)
+    table_name = "otodom_offers_params"
+
+    with metrics.timer("normalize_seconds"):
+        df = normalize_offers(offers, keep_raw)
+
+    if store in ("params", "both"):
+        logger.info(
+            f"Saving {len(offers)} rows into table: "
+            f"{credentials['database']}.{table_name}"
+        )
+        with metrics.timer("save_offers_params_seconds"):
+            copy_dataframe(
+                engine, table_name, df, upsert_keys=["id"] if upsert else None
+            )
+
+        metrics.inc("offers_saved_total", len(df))
 
+    if store in ("history", "both"):
+        save_offers_history_to_db(logger, df, credentials)
 
-def scrapper_loop(logger, offer_ids, wait, dry_run):
+
+def skip_done_offers(logger, run_state, offer_ids, offer_ids_count):
+    """
+    Skips offers already saved in resumed run, returns ids left and
+    their estimated count
     """
-    Get offers params using get_offer_params() for offers
-    from offer_ids list and prepare pandas data frame with
-    them.
+    done_count = run_state.count_done_offers()
+    logger.info(f"{done_count} offers already saved in this run")
+
+    offer_ids = run_state.pending_offer_ids(offer_ids)
+
+    return offer_ids, max(offer_ids_count - done_count, 0)
+
+
+def scrapper_loop(
+    logger,
+    offer_ids,
+    concurrency,
+    rate,
+    dry_run,
+    upsert=False,
+    backend=DEFAULT_BACKEND,
+    processes=None,
+    run_state=None,
+    max_rate=None,
+    cache=None,
+    archive=None,
+    keep_raw=False,
+    store="params",
+    save=None,
+    offer_url=OFFER_URL,
+    offer_ids_count=None,
+    batch_size=BATCH_SIZE,
+):
     """
-    offer_ids_count = len(offer_ids)
-    runtime_timedelta = datetime.timedelta(seconds=(offer_ids_count * wait))
+    Get offers params using parse_offer_params() for offers from
+    offer_ids iterable, fetching them concurrently and parsing them in
+    a pool of processes, and save them in batches of batch_size using
+    save_offers_params_to_db() or save(), if given. Offer ids are taken
+    lazily, offer_ids_count is used for runtime estimate only. Saved
+    offers are marked done in run_state.
+    """
+    if offer_ids_count is None:
+        offer_ids_count = len(offer_ids)
+
+    runtime_seconds = offer_ids_count / rate if rate > 0 else 0
+    runtime_timedelta = datetime.timedelta(seconds=runtime_seconds)
     logger.info(f"Estimated runtime {runtime_timedelta}")
 
     if dry_run is False:
-        results = list()
-        for index, id in enumerate(offer_ids):
-            url = f"https://www.otodom.pl/pl/oferta/{id}"
-
-            try:
-                offer_params = get_offer_params(url)
-            except AttributeError:
-                logger.warning(f"Broken URL: {url}")
-                pass
-
-            offer = dict()
-            offer["create_timestamp"] = datetime.datetime.now()
-            offer["id"] = id
-            offer = {**offer, **offer_params}
-            results.append(offer)
-
-            logger_info_condition = (
-                (index > 0 and index % 150 == 0) or
-                (index > 0 and index == len(offer_ids)-1)
+
+        def save_results(results):
+            if save is not None:
+                save(results)
+            else:
+                save_offers_params_to_db(
+                    logger, results, get_creds(), upsert, keep_raw, store
+                )
+
+            if run_state is not None:
+                run_state.mark_offers_done([offer["id"] for offer in results])
+
+        asyncio.run(
+            fetch_offers(
+                logger,
+                offer_ids,
+                parse=functools.partial(parse_offer_params, backend=backend),
+                save=save_results,
+                concurrency=concurrency,
+                batch_size=batch_size,
+                rate=rate,
+                max_rate=max_rate,
+                processes=processes,
+                cache=cache,
+                archive=archive,
+                offer_url=offer_url,
+                backend=backend,
             )
-            if logger_info_condition:
-                logger.info(f"{index+1} offers processed")
+        )
+
 
-            save_condition = (
-                (index > 0 and index % 1000 == 0) or
-                (index > 0 and index == len(offer_ids)-1)
+def replay_loop(
+    logger,
+    archive_dir,
+    dry_run,
+    upsert=False,
+    backend=DEFAULT_BACKEND,
+    processes=None,
+    keep_raw=False,
+    store="params",
+):
+    """
+    Parses offer pages saved in archive again, without network, and
+    saves offers params using save_offers_params_to_db()
+    """
+
+    def save(results):
+        if dry_run is False:
+            save_offers_params_to_db(
+                logger, results, get_creds(), upsert, keep_raw, store
             )
-            if save_condition:
-                df = pd.DataFrame(results)
-                save_offers_params_to_db(logger, df, get_creds())
-                results.clear()
-                del df
 
-            time.sleep(wait)
+    replay(
+        logger,
+        archive_dir,
+        parse=functools.partial(parse_offer_params, backend=backend),
+        save=save,
+        processes=processes,
+    )
 
 
 def validate_date(logger, date_text):
@@ -145,15 +331,190 @@ def validate_date(logger, date_text):
         logger.error("Incorrect date format, should be YYYY-MM-DD")
 
 
+def run(logger, args, concurrency, rate, dry_run):
+    """
+    Runs job selected by command line arguments
+    """
+    if args.date and validate_date(logger, args.date):
+        logger.info(f"[date] {args.date}")
+
+        run_state = RunState(f"{APP_NAME}:{args.date}")
+        if args.resume:
+            logger.info(f"Resuming run {run_state.run_id}")
+        else:
+            run_state.reset()
+
+        cache = None
+        if args.cache:
+            logger.info(f"Response cache {args.cache}")
+            cache = ResponseCache(args.cache, max_size=args.cache_size * 1024 * 1024)
+
+        archive = None
+        if args.archive:
+            logger.info(f"Archiving offer pages in {args.archive}")
+            archive = HtmlArchive(args.archive)
+
+        offer_ids_count = count_offer_ids_from_db(
+            logger, get_creds(), args.date, ttl=args.ttl, new_first=args.new_first
+        )
+        offer_ids = iter_offer_ids_from_db(
+            logger, get_creds(), args.date, ttl=args.ttl, new_first=args.new_first
+        )
+        if args.resume:
+            offer_ids, offer_ids_count = skip_done_offers(
+                logger, run_state, offer_ids, offer_ids_count
+            )
+
+        scrapper_loop(
+            logger,
+            offer_ids,
+            concurrency,
+            rate,
+            dry_run,
+            upsert=args.upsert,
+            backend=args.parser,
+            processes=args.processes,
+            run_state=run_state,
+            max_rate=args.max_rate,
+            cache=cache,
+            archive=archive,
+            keep_raw=args.keep_raw,
+            store=args.store,
+            offer_ids_count=offer_ids_count,
+            batch_size=args.batch_size,
+        )
+        run_state.close()
+
+        if cache is not None:
+            cache.close()
+
+        if archive is not None:
+            archive.close()
+
+    if args.replay:
+        logger.info(f"[replay] {args.replay}")
+        replay_loop(
+            logger,
+            args.replay,
+            dry_run,
+            upsert=args.upsert,
+            backend=args.parser,
+            processes=args.processes,
+            keep_raw=args.keep_raw,
+            store=args.store,
+        )
+
+    if args.url:
+        url = args.url
+        logger.info(f"[url] {url}")
+        try:
+            offer_params = get_offer_params(url, args.parser)
+
+            for key, value in offer_params.items():
+                print(f"{key}: {value}")
+
+        except AttributeError:
+            logger.error(f"Incorrect otodom offer URL: {url}")
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--date", help="extract date from database")
     group.add_argument("--url", help="otodom offer URL")
-    parser.add_argument("--wait", help="wait")
+    group.add_argument(
+        "--replay",
+        help="parse offer pages from archive directory instead of fetching",
+        nargs="?",
+        const=ARCHIVE_DIR,
+    )
+    parser.add_argument("--wait", help="wait between offers (sets rate to 1/wait)")
+    parser.add_argument("--rate", help="starting requests per second", type=float)
+    parser.add_argument(
+        "--max_rate", help="requests per second never exceeded", type=float
+    )
+    parser.add_argument(
+        "--concurrency", help="max offers fetched at once", type=int, default=8
+    )
     parser.add_argument("--dry_run", help="dry run", nargs="?", const=True, type=bool)
+    parser.add_argument(
+        "--upsert", help="replace offers already saved that day", action="store_true"
+    )
+    parser.add_argument(
+        "--parser",
+        help="offer page parser, json reads __NEXT_DATA__ instead of HTML",
+        choices=list(OFFER_PARSERS),
+        default=DEFAULT_BACKEND,
+    )
+    parser.add_argument(
+        "--processes",
+        help="parser processes (default: CPU count, 0: parse in threads)",
+        type=int,
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="offers saved into database at once",
+        type=int,
+        default=BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--resume", help="continue previous run from checkpoint", action="store_true"
+    )
+    parser.add_argument(
+        "--cache",
+        help="cache offer pages in SQLite file for conditional requests",
+        nargs="?",
+        const=CACHE_PATH,
+    )
+    parser.add_argument(
+        "--cache_size", help="max cache size in MB", type=int, default=1024
+    )
+    parser.add_argument(
+        "--archive",
+        help="append raw offer pages to archive directory",
+        nargs="?",
+        const=ARCHIVE_DIR,
+    )
+    parser.add_argument(
+        "--keep_raw",
+        help="keep raw price, area, rooms and floor strings",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--store",
+        help="save offers params, only their changes into history, or both",
+        choices=STORES,
+        default="params",
+    )
+    parser.add_argument(
+        "--metrics_port", help="serve metrics on localhost:PORT/metrics", type=int
+    )
+    parser.add_argument(
+        "--profile",
+        help="profile run, stacks and top allocations go into logs/",
+        nargs="?",
+        choices=PROFILERS,
+        const="sample",
+    )
+    parser.add_argument(
+        "--profile_items",
+        help="offers processed while allocations are traced",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--ttl", help="skip offers scraped within last TTL hours", type=float
+    )
+    parser.add_argument(
+        "--new_first", help="scrape never seen offers first", action="store_true"
+    )
     args = parser.parse_args()
 
+    # Last scraped times are read from otodom_offers_params, which
+    # history store does not write
+    if args.store == "history" and (args.ttl is not None or args.new_first):
+        parser.error("--ttl and --new_first need --store params or both")
+
     log_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     log_dir = "logs"
     log_path = f"{log_dir}/{APP_NAME}_{log_timestamp}.log"
@@ -175,12 +536,21 @@ def main(argv):
     logger = logging.getLogger(APP_NAME)
     logger.info(f"Starting {APP_NAME}")
 
-    if args.wait is not None:
-        wait = int(args.wait)
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+        logger.info(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    if args.rate is not None:
+        rate = args.rate
+    elif args.wait is not None:
+        wait = float(args.wait)
+        rate = 1 / wait if wait > 0 else 0
     else:
-        wait = 1
+        rate = 1.0
+
+    concurrency = args.concurrency
 
-    logger.info(f"Wait between offers {wait}s")
+    logger.info(f"Rate limit {rate} requests/s, concurrency {concurrency}")
 
     if args.dry_run is None:
         dry_run = False
@@ -188,24 +558,13 @@ def main(argv):
         dry_run = args.dry_run
         logger.info(f"Dry run {dry_run}")
 
-    if args.date and validate_date(logger, args.date):
-        logger.info(f"[date] {args.date}")
-
-        offer_ids = get_offer_ids_from_db(logger, get_creds(), args.date)
-        scrapper_loop(logger, offer_ids, wait, dry_run)
-
-    if args.url:
-        url = args.url
-        logger.info(f"[url] {url}")
-        try:
-            offer_params = get_offer_params(url)
-
-            for key, value in offer_params.items():
-                print(f"{key}: {value}")
-
-        except AttributeError:
-            logger.error(f"Incorrect otodom offer URL: {url}")
+    with profile(
+        logger, APP_NAME, args.profile, "offers_processed_total", args.profile_items
+    ):
+        run(logger, args, concurrency, rate, dry_run)
 
+    dispose_engines()
+    metrics.log_summary(logger)
     logger.info(f"{APP_NAME} finished")
 
 
@@ -0,0 +1,445 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import sys
+
+import unidecode
+from bs4 import BeautifulSoup
+
+import http_client
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    import orjson as json_decoder
+except ImportError:
+    json_decoder = json
+
+OFFER_PARAM_CLASS = "css-1wi2w6s enb64yk4"
+NEXT_DATA_PATTERN = re.compile(
+    rb'<script id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.DOTALL
+)
+FIXTURES_DIR = "fixtures"
+# Broken pages every backend has to handle the same way as bs4
+EMPTY_PAGES = [b"", b" \n\t "]
+# Personal data removed from captured pages: values of these keys in
+# __NEXT_DATA__ and emails and phone numbers anywhere in the page
+PERSONAL_KEYS = {"owner", "agency", "contactDetails", "phones", "phone", "email"}
+EMAIL_PATTERN = re.compile(rb"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE_PATTERN = re.compile(rb"(?:\+48[ -]?)?\b\d{3}[ -]\d{3}[ -]\d{3}\b")
+REMOVED = b"[removed]"
+
+
+def offer_param_key(label):
+    return unidecode.unidecode(str(label).replace(" / ", "_").replace(" ", "_").lower())
+
+
+def parse_offer_params_bs4(content):
+    """
+    Parses offer params from offer page HTML with BeautifulSoup
+    """
+    soup = BeautifulSoup(content, "html.parser")
+
+    offer_params = soup.find_all("div", {"class": OFFER_PARAM_CLASS})
+
+    results = dict()
+
+    price = soup.find("strong", {"aria-label": "Cena"}).get_text()
+    results["price"] = unidecode.unidecode(price)
+
+    price_m2 = soup.find("div", {"aria-label": "Cena za metr kwadratowy"}).get_text()
+    results["price_m2"] = unidecode.unidecode(price_m2)
+
+    address = soup.find("a", {"aria-label": "Adres"}).get_text()
+    results["address"] = unidecode.unidecode(address)
+
+    for line in offer_params:
+        k = offer_param_key(line.parent.parent["aria-label"])
+        v = unidecode.unidecode(str(line.get_text()).strip())
+        results[k] = v
+
+    return results
+
+
+def get_offers_ids_bs4(page_source):
+    """
+    Takes otodom listing page and get all offer ids from that page
+    with BeautifulSoup
+    """
+
+    soup = BeautifulSoup(page_source, "html.parser")
+
+    listing_items = soup.find_all("li", {"data-cy": "listing-item"})
+
+    offer_urls = []
+    for item in listing_items:
+        a = item.find("a", {"data-cy": "listing-item-link"})
+        href_array = a["href"].split("/")
+
+        offer_id = href_array[len(href_array) - 1]
+
+        offer_urls.append(offer_id)
+
+    return offer_urls
+
+
+def lxml_document(content):
+    """
+    HTML tree of page, raises AttributeError for empty page like
+    BeautifulSoup parsers do for broken pages
+    """
+    try:
+        if isinstance(content, bytes):
+            parser = lxml.html.HTMLParser(encoding="utf-8")
+            return lxml.html.document_fromstring(content, parser=parser)
+
+        return lxml.html.document_fromstring(content)
+    except lxml.etree.ParserError as e:
+        raise AttributeError(f"Page not parsed: {e}") from e
+
+
+def lxml_text(tree, xpath):
+    """
+    Text of first element matching xpath, raises AttributeError like
+    BeautifulSoup does when element is missing
+    """
+    elements = tree.xpath(xpath)
+    if not elements:
+        raise AttributeError(f"Element not found: {xpath}")
+
+    return elements[0].text_content()
+
+
+def parse_offer_params_lxml(content):
+    """
+    Parses offer params from offer page HTML with lxml, gives the same
+    dict as parse_offer_params_bs4()
+    """
+    tree = lxml_document(content)
+
+    results = dict()
+
+    price = lxml_text(tree, '//strong[@aria-label="Cena"]')
+    results["price"] = unidecode.unidecode(price)
+
+    price_m2 = lxml_text(tree, '//div[@aria-label="Cena za metr kwadratowy"]')
+    results["price_m2"] = unidecode.unidecode(price_m2)
+
+    address = lxml_text(tree, '//a[@aria-label="Adres"]')
+    results["address"] = unidecode.unidecode(address)
+
+    for line in tree.xpath(f'//div[@class="{OFFER_PARAM_CLASS}"]'):
+        label = line.getparent().getparent().get("aria-label")
+        if label is None:
+            raise KeyError("aria-label")
+
+        k = offer_param_key(label)
+        v = unidecode.unidecode(line.text_content().strip())
+        results[k] = v
+
+    return results
+
+
+def get_offers_ids_lxml(page_source):
+    """
+    Takes otodom listing page and get all offer ids from that page
+    with lxml
+    """
+    try:
+        tree = lxml_document(page_source)
+    except AttributeError:
+        # Empty page has no offers, like with bs4
+        return []
+
+    offer_urls = []
+    for item in tree.xpath('//li[@data-cy="listing-item"]'):
+        a = item.xpath('.//a[@data-cy="listing-item-link"]')[0]
+        offer_urls.append(a.get("href").split("/")[-1])
+
+    return offer_urls
+
+
+def get_next_data(content):
+    """
+    Decodes __NEXT_DATA__ JSON embedded in otodom page without
+    building HTML tree
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    match = NEXT_DATA_PATTERN.search(content)
+    if match is None:
+        raise AttributeError("__NEXT_DATA__ not found in page")
+
+    return json_decoder.loads(match.group(1))
+
+
+def to_number(value, cast=float):
+    try:
+        return cast(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_offer_params_json(content):
+    """
+    Parses offer params from ad object in __NEXT_DATA__ JSON. Text params
+    get the same keys and format as HTML parsers, price, price per m2,
+    area, rooms and coordinates are also taken as numbers
+    """
+    ad = get_next_data(content)["props"]["pageProps"].get("ad")
+    if ad is None:
+        raise AttributeError("Ad not found in __NEXT_DATA__")
+
+    characteristics = {c["key"]: c for c in ad.get("characteristics") or []}
+
+    price = characteristics.get("price")
+    if price is None:
+        raise AttributeError("Price not found in __NEXT_DATA__")
+
+    results = dict()
+    results["price"] = unidecode.unidecode(price["localizedValue"])
+
+    price_m2 = characteristics.get("price_per_m")
+    if price_m2 is not None:
+        results["price_m2"] = unidecode.unidecode(price_m2["localizedValue"])
+
+    address = ad["location"]["address"]
+    address_parts = [
+        (address.get("street") or {}).get("name"),
+        (address.get("district") or {}).get("name"),
+        (address.get("city") or {}).get("name"),
+        (address.get("province") or {}).get("name"),
+    ]
+    results["address"] = unidecode.unidecode(
+        ", ".join([part for part in address_parts if part])
+    )
+
+    for key, characteristic in characteristics.items():
+        if key in ("price", "price_per_m"):
+            continue
+
+        k = offer_param_key(characteristic["label"])
+        v = unidecode.unidecode(str(characteristic["localizedValue"]).strip())
+        results[k] = v
+
+    coordinates = ad["location"].get("coordinates") or {}
+
+    results["price_pln"] = to_number(price.get("value"))
+    results["price_m2_pln"] = to_number((price_m2 or {}).get("value"))
+    results["area_m2"] = to_number((characteristics.get("m") or {}).get("value"))
+    results["rooms"] = to_number(
+        (characteristics.get("rooms_num") or {}).get("value"), int
+    )
+    results["latitude"] = to_number(coordinates.get("latitude"))
+    results["longitude"] = to_number(coordinates.get("longitude"))
+
+    return results
+
+
+OFFER_PARSERS = {
+    "bs4": parse_offer_params_bs4,
+    "lxml": parse_offer_params_lxml,
+    "json": parse_offer_params_json,
+}
+# Bump version of backend after changing its output, so that params
+# kept in response cache are parsed again
+PARSER_VERSIONS = {
+    "bs4": 1,
+    "lxml": 1,
+    "json": 1,
+}
+LISTING_PARSERS = {
+    "bs4": get_offers_ids_bs4,
+    "lxml": get_offers_ids_lxml,
+}
+# HTML backends have to give identical results, see check_fixtures()
+HTML_BACKENDS = ["bs4", "lxml"] if lxml is not None else ["bs4"]
+DEFAULT_BACKEND = "lxml" if lxml is not None else "bs4"
+
+
+def parse_offer_params(content, backend=DEFAULT_BACKEND):
+    """
+    Parses offer params from offer page with selected backend
+    """
+    return OFFER_PARSERS[backend](content)
+
+
+def get_offers_ids(page_source, backend=DEFAULT_BACKEND):
+    """
+    Takes otodom listing page and get all offer ids from that page
+    with selected backend
+    """
+    return LISTING_PARSERS[backend](page_source)
+
+
+def parse_outcome(parse, content):
+    """
+    Result of parse() or name of exception it raised
+    """
+    try:
+        return parse(content)
+    except Exception as e:
+        return type(e).__name__
+
+
+def remove_personal_keys(data):
+    """
+    Copy of JSON data with values of PERSONAL_KEYS set to None
+    """
+    if isinstance(data, dict):
+        return {
+            k: None if k in PERSONAL_KEYS else remove_personal_keys(v)
+            for k, v in data.items()
+        }
+    if isinstance(data, list):
+        return [remove_personal_keys(v) for v in data]
+
+    return data
+
+
+def strip_personal_data(content):
+    """
+    Removes sellers and agents contact data from otodom page, so that
+    it can be committed as fixture
+    """
+    match = NEXT_DATA_PATTERN.search(content)
+    if match is not None:
+        data = remove_personal_keys(json.loads(match.group(1)))
+        next_data = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        content = content[: match.start(1)] + next_data + content[match.end(1) :]
+
+    content = EMAIL_PATTERN.sub(REMOVED, content)
+
+    return PHONE_PATTERN.sub(REMOVED, content)
+
+
+def write_golden(golden_path, result):
+    with open(golden_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+def capture_fixture(url, kind="offers", fixtures_dir=FIXTURES_DIR):
+    """
+    Saves otodom offer or listing page without personal data as HTML
+    fixture with golden JSON file from bs4 backend, returns its path
+    """
+    parsers = OFFER_PARSERS if kind == "offers" else LISTING_PARSERS
+
+    r = http_client.get(url)
+    r.raise_for_status()
+    content = strip_personal_data(r.content)
+
+    name = url.split("?")[0].rstrip("/").split("/")[-1]
+    html_path = os.path.join(fixtures_dir, kind, f"{name}.html")
+    os.makedirs(os.path.dirname(html_path), exist_ok=True)
+
+    with open(html_path, "wb") as f:
+        f.write(content)
+    write_golden(f"{os.path.splitext(html_path)[0]}.json", parsers["bs4"](content))
+
+    return html_path
+
+
+def check_fixtures(fixtures_dir=FIXTURES_DIR, update=False):
+    """
+    Runs every HTML backend over saved HTML fixtures (offers/*.html and
+    listings/*.html) and compares results with golden JSON files next
+    to them, then checks that empty pages give the same result or
+    exception as bs4. With update golden files are written from bs4
+    backend. Returns list of mismatches, raises FileNotFoundError
+    when there are no fixtures
+    """
+    mismatches = list()
+    checked = 0
+
+    for kind, parsers in [("offers", OFFER_PARSERS), ("listings", LISTING_PARSERS)]:
+        for html_path in sorted(glob.glob(os.path.join(fixtures_dir, kind, "*.html"))):
+            golden_path = f"{os.path.splitext(html_path)[0]}.json"
+
+            with open(html_path, "rb") as f:
+                content = f.read()
+
+            if update:
+                write_golden(golden_path, parsers["bs4"](content))
+
+            with open(golden_path, encoding="utf-8") as f:
+                golden = json.load(f)
+
+            for backend in HTML_BACKENDS:
+                result = parsers[backend](content)
+                if result != golden:
+                    mismatches.append((html_path, backend, result, golden))
+
+            checked += 1
+
+        # bs4 warns that empty bytes could not be decoded, expected here
+        logging.disable(logging.WARNING)
+        try:
+            for content in EMPTY_PAGES:
+                expected = parse_outcome(parsers["bs4"], content)
+                for backend in HTML_BACKENDS:
+                    result = parse_outcome(parsers[backend], content)
+                    if result != expected:
+                        mismatches.append(
+                            (f"{kind}: {content!r}", backend, result, expected)
+                        )
+        finally:
+            logging.disable(logging.NOTSET)
+
+    if checked == 0:
+        raise FileNotFoundError(f"No HTML fixtures found in {fixtures_dir}")
+
+    return mismatches
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fixtures", help="directory with saved HTML fixtures", default=FIXTURES_DIR
+    )
+    parser.add_argument(
+        "--update", help="rewrite golden files from bs4 backend", action="store_true"
+    )
+    parser.add_argument(
+        "--capture", help="save otodom page without personal data as fixture"
+    )
+    parser.add_argument(
+        "--kind",
+        help="kind of captured page",
+        choices=["offers", "listings"],
+        default="offers",
+    )
+    args = parser.parse_args()
+
+    if args.capture:
+        html_path = capture_fixture(args.capture, args.kind, args.fixtures)
+        print(f"Fixture saved into {html_path}, check it before committing")
+
+    try:
+        mismatches = check_fixtures(args.fixtures, update=args.update)
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    for html_path, backend, result, golden in mismatches:
+        print(f"[{backend}] {html_path}")
+        print(f"  expected: {golden}")
+        print(f"  got:      {result}")
+
+    if mismatches:
+        sys.exit(1)
+
+    print("All backends match golden files")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
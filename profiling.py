@@ -0,0 +1,233 @@
+import collections
+import contextlib
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+import metrics
+
+PROFILERS = ["sample", "cprofile"]
+SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 30
+TOP_FUNCTIONS = 50
+
+
+class StackSampler:
+    """
+    Sampling profiler: a daemon thread records stacks of all other
+    threads every interval seconds, stacks are written in collapsed
+    format ("thread;outer;...;inner count") read by flamegraph.pl,
+    speedscope and similar tools
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        own_id = threading.get_ident()
+
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    file_name = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({file_name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ThreadProfiler:
+    """
+    cProfile of all threads: before Python 3.12 cProfile hooks only
+    the thread that enabled it, so every thread started while profiling
+    (thread pools, asyncio.to_thread, parsing in threads) gets its own
+    profiler, their stats are merged at the end. Since 3.12 cProfile
+    sees all threads by itself
+    """
+
+    def __init__(self):
+        self.profilers = list()
+        self.lock = threading.Lock()
+
+    def add_profiler(self):
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+
+    def profile_thread(self, frame, event, arg):
+        # Called on the first event of a new thread, enabled profiler
+        # replaces this hook
+        self.add_profiler()
+
+    def start(self):
+        self.add_profiler()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.profile_thread)
+
+    def stop(self):
+        threading.setprofile(None)
+        with self.lock:
+            for profiler in self.profilers:
+                profiler.disable()
+
+    def stats(self, stream):
+        with self.lock:
+            first, *rest = self.profilers
+            stats = pstats.Stats(first, stream=stream)
+            for profiler in rest:
+                stats.add(profiler)
+
+        return stats
+
+
+class AllocationTracer:
+    """
+    Traces allocations with tracemalloc until items_metric counter
+    reaches items, then writes top allocations and stops tracing,
+    so that the rest of the run is not slowed down
+    """
+
+    def __init__(self, path, items_metric, items):
+        self.path = path
+        self.items_metric = items_metric
+        self.items = items
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.written = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        while not self.stopped.wait(0.5):
+            if metrics.value(self.items_metric) >= self.items:
+                self.write()
+                return
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def write(self):
+        with self.lock:
+            if self.written:
+                return
+            self.written = True
+
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        items = metrics.value(self.items_metric)
+
+        with open(self.path, "w") as f:
+            f.write(f"Allocations traced over {items} {self.items_metric}\n")
+            f.write(f"Current {current / 1024 / 1024:.1f} MB, ")
+            f.write(f"peak {peak / 1024 / 1024:.1f} MB\n\n")
+
+            for stat in snapshot.statistics("traceback")[:TOP_ALLOCATIONS]:
+                f.write(f"{stat.size / 1024:.1f} KB in {stat.count} blocks\n")
+                for line in stat.traceback.format():
+                    f.write(f"{line}\n")
+                f.write("\n")
+
+
+def stop_inherited_profiling():
+    """
+    Initializer of parser pools: worker forked from profiled process
+    inherits tracemalloc and cProfile hook, which would slow parsing
+    down for the whole run, while its results are never collected
+    """
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    threading.setprofile(None)
+    sys.setprofile(None)
+
+
+@contextlib.contextmanager
+def profile(logger, app_name, profiler=None, items_metric=None, items=1000):
+    """
+    Runs with block under sampling profiler or cProfile of all threads
+    and traces allocations over first items counted by items_metric.
+    Reports go into logs/. Does nothing without profiler
+    """
+    if profiler is None:
+        yield
+        return
+
+    log_dir = "logs"
+    os.makedirs(log_dir, exist_ok=True)
+    log_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    prefix = os.path.join(log_dir, f"{app_name}_{log_timestamp}")
+
+    tracer = AllocationTracer(f"{prefix}_allocations.txt", items_metric, items)
+
+    if profiler == "sample":
+        sampler = StackSampler()
+        sampler.start()
+    else:
+        cprofile = ThreadProfiler()
+        cprofile.start()
+
+    tracer.start()
+    logger.info(f"Profiling with {profiler}, allocations over {items} items")
+
+    try:
+        yield
+    finally:
+        tracer.stop()
+
+        if profiler == "sample":
+            sampler.stop()
+            sampler.write(f"{prefix}_stacks.folded")
+            logger.info(f"Collapsed stacks saved into {prefix}_stacks.folded")
+        else:
+            cprofile.stop()
+
+            report = io.StringIO()
+            stats = cprofile.stats(report)
+            stats.dump_stats(f"{prefix}.prof")
+            stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            with open(f"{prefix}_profile.txt", "w") as f:
+                f.write(report.getvalue())
+
+            logger.info(f"Profile saved into {prefix}.prof and {prefix}_profile.txt")
+
+        logger.info(f"Top allocations saved into {prefix}_allocations.txt")
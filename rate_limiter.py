@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import threading
+import time
+from urllib.parse import urlsplit
+
+THROTTLE_STATUSES = (429, 503)
+# Only these responses let rate grow, other errors leave it as it is
+SUCCESS_STATUSES = range(200, 300)
+NOT_MODIFIED = 304
+INCREASE_STEP = 0.05
+DECREASE_FACTOR = 0.5
+LATENCY_DECREASE_FACTOR = 0.8
+LATENCY_FACTOR = 2.0
+LATENCY_WINDOW = 50
+DECREASE_COOLDOWN = 2.0
+LOG_EVERY = 200
+
+
+class TokenBucket:
+    """
+    Token bucket of single host with AIMD rate: rate grows additively
+    after every successful (2xx/304) response and is cut multiplicatively
+    on 429/503 responses or when p95 latency rises well above its
+    baseline. Other errors do not change rate
+    """
+
+    def __init__(self, host, rate, min_rate, max_rate, logger=None):
+        self.host = host
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.logger = logger
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.decreased_at = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.baseline_p95 = None
+        self.responses = 0
+
+    def reserve(self):
+        """
+        Takes one token and returns seconds to wait before using it
+        """
+        now = time.monotonic()
+
+        if self.rate <= 0:
+            return max(self.paused_until - now, 0)
+
+        self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        return max(wait, self.paused_until - now)
+
+    def p95(self):
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def feedback(self, status, latency, retry_after=None):
+        self.responses += 1
+
+        if retry_after:
+            self.paused_until = time.monotonic() + retry_after
+
+        if status in THROTTLE_STATUSES:
+            self.decrease(DECREASE_FACTOR, f"HTTP {status}")
+            return
+
+        if status not in SUCCESS_STATUSES and status != NOT_MODIFIED:
+            return
+
+        self.latencies.append(latency)
+
+        if len(self.latencies) == LATENCY_WINDOW:
+            p95 = self.p95()
+
+            if self.baseline_p95 is None or p95 < self.baseline_p95:
+                self.baseline_p95 = p95
+            elif p95 > self.baseline_p95 * LATENCY_FACTOR:
+                self.decrease(LATENCY_DECREASE_FACTOR, f"p95 latency {p95:.2f}s")
+                return
+
+        if self.rate > 0 and time.monotonic() >= self.paused_until:
+            self.rate = min(self.rate + INCREASE_STEP, self.max_rate)
+
+        if self.logger is not None and self.responses % LOG_EVERY == 0:
+            self.logger.info(f"[rate] {self.host} {self.rate:.2f} requests/s")
+
+    def decrease(self, factor, reason):
+        now = time.monotonic()
+
+        # Requests already in flight answer to the old rate, so
+        # one burst of throttled responses counts as one signal
+        if self.rate <= 0 or now - self.decreased_at < DECREASE_COOLDOWN:
+            return
+
+        self.decreased_at = now
+        self.rate = max(self.rate * factor, self.min_rate)
+        # Latencies measured at the old rate do not describe the new one
+        self.latencies.clear()
+
+        if self.logger is not None:
+            self.logger.warning(
+                f"[rate] {self.host} slowing down to {self.rate:.2f} requests/s "
+                f"({reason})"
+            )
+
+
+class AdaptiveRateLimiter:
+    """
+    Politeness limit shared by all fetchers, keeps one adaptive token
+    bucket per host. Rate starts at `rate` and moves between min_rate
+    and max_rate depending on feedback(). Rate 0 means no limit
+    """
+
+    def __init__(self, rate, min_rate=None, max_rate=None, logger=None):
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 10
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        self.logger = logger
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(
+                host, self.rate, self.min_rate, self.max_rate, self.logger
+            )
+
+        return self.buckets[host]
+
+    async def acquire(self, url):
+        with self.lock:
+            wait = self.bucket(url).reserve()
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def wait(self, url):
+        """
+        Blocking acquire() for synchronous callers
+        """
+        with self.lock:
+            wait = self.bucket(url).reserve()
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def feedback(self, url, status, latency, retry_after=None):
+        with self.lock:
+            self.bucket(url).feedback(status, latency, retry_after)
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CACHE_PATH = "response_cache.sqlite"
+CACHE_SIZE = 1024 * 1024 * 1024
+ZSTD_LEVEL = 3
+
+
+def compress(body):
+    """
+    Compresses body with zstd, zlib when zstandard is not installed.
+    Returns codec name and compressed bytes
+    """
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+    return "zlib", zlib.compress(body)
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return zlib.decompress(data)
+
+
+def body_hash(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+class ResponseCache:
+    """
+    Local cache of offer pages keyed by offer id, kept in SQLite file.
+    Stores ETag/Last-Modified headers for conditional requests, hash
+    and compressed body of the page and params parsed from it with
+    parser backend and its version. Least recently used entries are
+    evicted when bodies exceed max_size bytes
+    """
+
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        # Used from threads of asyncio.to_thread, one at a time
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "create table if not exists responses ("
+            "offer_id text primary key, etag text, last_modified text, "
+            "body_hash text, codec text, body blob, size integer, "
+            "params text, accessed_at real, parser text, parser_version integer)"
+        )
+
+        # Caches created before parser was recorded, their params are
+        # parsed again
+        columns = [row[1] for row in self.conn.execute("pragma table_info(responses)")]
+        for column, column_type in [("parser", "text"), ("parser_version", "integer")]:
+            if column not in columns:
+                self.conn.execute(
+                    f"alter table responses add column {column} {column_type}"
+                )
+        self.conn.execute(
+            "create index if not exists responses_accessed_at_idx "
+            "on responses (accessed_at)"
+        )
+        self.size = self.conn.execute(
+            "select coalesce(sum(size), 0) from responses"
+        ).fetchone()[0]
+
+    def get(self, offer_id):
+        """
+        Returns cached entry of offer as dict or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "select etag, last_modified, body_hash, params, parser, parser_version "
+                "from responses where offer_id = ?",
+                (offer_id,),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self.conn.execute(
+                "update responses set accessed_at = ? where offer_id = ?",
+                (time.time(), offer_id),
+            )
+
+        return {
+            "etag": row[0],
+            "last_modified": row[1],
+            "body_hash": row[2],
+            "params": json.loads(row[3]),
+            "parser": row[4],
+            "parser_version": row[5],
+        }
+
+    def get_body(self, offer_id):
+        with self.lock:
+            row = self.conn.execute(
+                "select codec, body from responses where offer_id = ?", (offer_id,)
+            ).fetchone()
+
+        return decompress(*row) if row is not None else None
+
+    def conditional_headers(self, entry):
+        """
+        Request headers that let server answer 304 Not Modified
+        """
+        headers = dict()
+        if entry is not None and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def put(
+        self,
+        offer_id,
+        body,
+        params,
+        etag=None,
+        last_modified=None,
+        parser=None,
+        parser_version=None,
+    ):
+        codec, data = compress(body)
+
+        with self.lock:
+            old = self.conn.execute(
+                "select size from responses where offer_id = ?", (offer_id,)
+            ).fetchone()
+            if old is not None:
+                self.size -= old[0]
+
+            self.conn.execute(
+                "insert or replace into responses "
+                "(offer_id, etag, last_modified, body_hash, codec, body, size, "
+                "params, accessed_at, parser, parser_version) "
+                "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    offer_id,
+                    etag,
+                    last_modified,
+                    body_hash(body),
+                    codec,
+                    data,
+                    len(data),
+                    json.dumps(params),
+                    time.time(),
+                    parser,
+                    parser_version,
+                ),
+            )
+            self.size += len(data)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries till cache fits in 90% of
+        max_size, so that eviction does not run on every put
+        """
+        target = self.max_size * 0.9
+        rows = self.conn.execute(
+            "select offer_id, size from responses order by accessed_at"
+        )
+
+        evicted = list()
+        for offer_id, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((offer_id,))
+            self.size -= size
+
+        self.conn.executemany("delete from responses where offer_id = ?", evicted)
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,407 @@
+import argparse
+import datetime
+import logging
+import sys
+
+from sqlalchemy import text
+
+from database import get_engine
+from utils import get_creds
+
+APP_NAME = "otodom_schema"
+
+TABLES = ["otodom_offers_ids", "otodom_offers_params"]
+HISTORY_TABLE = "otodom_offers_history"
+
+# Columns of both tables as first created by pandas to_sql, params
+# are text as scraped, keys made by offer_param_key() from otodom labels
+BASE_COLUMNS = {
+    "otodom_offers_ids": [
+        ("create_timestamp", "timestamp"),
+        ("listing_url", "text"),
+        ("offer_id", "text"),
+    ],
+    "otodom_offers_params": [
+        ("create_timestamp", "timestamp"),
+        ("id", "text"),
+        ("price", "text"),
+        ("price_m2", "text"),
+        ("address", "text"),
+        ("powierzchnia", "text"),
+        ("forma_wlasnosci", "text"),
+        ("liczba_pokoi", "text"),
+        ("stan_wykonczenia", "text"),
+        ("pietro", "text"),
+        ("balkon_ogrod_taras", "text"),
+        ("czynsz", "text"),
+        ("miejsce_parkingowe", "text"),
+        ("obsluga_zdalna", "text"),
+        ("ogrzewanie", "text"),
+        ("rynek", "text"),
+        ("typ_ogloszeniodawcy", "text"),
+        ("dostepne_od", "text"),
+        ("rok_budowy", "text"),
+        ("rodzaj_zabudowy", "text"),
+        ("okna", "text"),
+        ("winda", "text"),
+        ("media", "text"),
+        ("zabezpieczenia", "text"),
+        ("wyposazenie", "text"),
+        ("informacje_dodatkowe", "text"),
+        ("material_budynku", "text"),
+    ],
+}
+
+INDEXES = [
+    (
+        "otodom_offers_ids_create_timestamp_idx",
+        "otodom_offers_ids",
+        "(create_timestamp)",
+    ),
+    (
+        "otodom_offers_ids_offer_id_create_timestamp_idx",
+        "otodom_offers_ids",
+        "(offer_id, create_timestamp)",
+    ),
+    (
+        "otodom_offers_params_create_timestamp_idx",
+        "otodom_offers_params",
+        "(create_timestamp)",
+    ),
+    (
+        "otodom_offers_params_id_create_timestamp_idx",
+        "otodom_offers_params",
+        "(id, create_timestamp)",
+    ),
+    (
+        "otodom_offers_history_id_current_idx",
+        HISTORY_TABLE,
+        "(id) where valid_to is null",
+    ),
+    (
+        "otodom_offers_history_id_valid_from_idx",
+        HISTORY_TABLE,
+        "(id, valid_from)",
+    ),
+]
+
+# Typed columns filled by json offer parser and by normalize_offers()
+COLUMNS = [
+    ("otodom_offers_params", "price_pln", "numeric"),
+    ("otodom_offers_params", "price_m2_pln", "numeric"),
+    ("otodom_offers_params", "currency", "text"),
+    ("otodom_offers_params", "area_m2", "numeric"),
+    ("otodom_offers_params", "rooms", "smallint"),
+    ("otodom_offers_params", "floor", "smallint"),
+    ("otodom_offers_params", "floors_total", "smallint"),
+    ("otodom_offers_params", "latitude", "double precision"),
+    ("otodom_offers_params", "longitude", "double precision"),
+]
+
+# Columns of offers history on top of otodom_offers_params ones,
+# version of offer is valid from valid_from till valid_to (exclusive)
+HISTORY_COLUMNS = [
+    ("params_hash", "text"),
+    ("valid_from", "timestamp"),
+    ("valid_to", "timestamp"),
+]
+
+# Offers of selected day as they were at the end of that day, like
+# rows of otodom_offers_params for that day
+SNAPSHOT_FUNCTION = f"""
+create or replace function public.otodom_offers_snapshot(snapshot_day date)
+returns setof public.{HISTORY_TABLE}
+language sql stable
+as $$
+    select h.*
+    from public.{HISTORY_TABLE} h
+    where h.valid_from < snapshot_day + 1
+    and (h.valid_to is null or h.valid_to >= snapshot_day + 1)
+    and exists (
+        select 1
+        from public.otodom_offers_ids i
+        where i.offer_id = h.id
+        and i.create_timestamp >= snapshot_day
+        and i.create_timestamp < snapshot_day + 1
+    )
+$$
+"""
+
+CURRENT_VIEW = f"""
+create or replace view public.otodom_offers_current as
+select * from public.{HISTORY_TABLE} where valid_to is null
+"""
+
+
+def is_partitioned(conn, table_name):
+    query = """
+    select c.relkind = 'p'
+    from pg_class c
+    join pg_namespace n on n.oid = c.relnamespace
+    where n.nspname = 'public' and c.relname = :table_name
+    """
+
+    return bool(conn.execute(text(query), {"table_name": table_name}).scalar())
+
+
+def create_tables(logger, conn):
+    """
+    Creates both tables missing in fresh database, COPY used by
+    scrappers can not create them
+    """
+    for table_name, columns in BASE_COLUMNS.items():
+        logger.info(f"Creating table {table_name}")
+        columns_sql = ", ".join(
+            [f"{column_name} {column_type}" for column_name, column_type in columns]
+        )
+        conn.execute(
+            text(f"create table if not exists public.{table_name} ({columns_sql})")
+        )
+
+
+def add_columns(logger, conn):
+    """
+    Adds typed columns missing in existing tables
+    """
+    for table_name, column_name, column_type in COLUMNS:
+        logger.info(f"Adding column {table_name}.{column_name}")
+        conn.execute(
+            text(
+                f"alter table public.{table_name} "
+                f"add column if not exists {column_name} {column_type}"
+            )
+        )
+
+
+def create_indexes(logger, conn):
+    """
+    Creates indexes used by daily range filters and per offer lookups
+    """
+    for index_name, table_name, columns in INDEXES:
+        logger.info(f"Creating index {index_name}")
+        conn.execute(
+            text(
+                f"create index if not exists {index_name} "
+                f"on public.{table_name} {columns}"
+            )
+        )
+
+
+def create_history(logger, conn):
+    """
+    Creates offers history table with columns of otodom_offers_params,
+    view of current versions of offers and otodom_offers_snapshot(day)
+    function returning offers of any day
+    """
+    logger.info(f"Creating table {HISTORY_TABLE}")
+    conn.execute(
+        text(
+            f"create table if not exists public.{HISTORY_TABLE} "
+            f"(like public.otodom_offers_params including defaults)"
+        )
+    )
+
+    # Typed columns added to otodom_offers_params after history was created
+    columns = [
+        (column_name, column_type)
+        for table_name, column_name, column_type in COLUMNS
+        if table_name == "otodom_offers_params"
+    ]
+    for column_name, column_type in columns + HISTORY_COLUMNS:
+        conn.execute(
+            text(
+                f"alter table public.{HISTORY_TABLE} "
+                f"add column if not exists {column_name} {column_type}"
+            )
+        )
+
+    conn.execute(text(CURRENT_VIEW))
+    conn.execute(text(SNAPSHOT_FUNCTION))
+
+
+def table_exists(conn, table_name):
+    return bool(
+        conn.execute(
+            text("select to_regclass(:table_name) is not null"),
+            {"table_name": f"public.{table_name}"},
+        ).scalar()
+    )
+
+
+def default_partition_first_day(conn, table_name):
+    """
+    First day of rows in default partition of table, rows land there
+    when migration did not run for more than days_ahead days
+    """
+    default_name = f"{table_name}_default"
+    if not table_exists(conn, default_name):
+        return None
+
+    return conn.execute(
+        text(f"select min(create_timestamp)::date from public.{default_name}")
+    ).scalar()
+
+
+def create_daily_partitions(logger, conn, table_name, date_from, date_to):
+    """
+    Creates one partition per day of partitioned table for
+    days from date_from to date_to (inclusive). Rows of those days
+    already in default partition are moved into the new partition,
+    default partition can not keep rows of any existing partition
+    """
+    default_name = f"{table_name}_default"
+    has_default = table_exists(conn, default_name)
+
+    for offset in range((date_to - date_from).days + 1):
+        day = date_from + datetime.timedelta(days=offset)
+        next_day = day + datetime.timedelta(days=1)
+        partition_name = f"{table_name}_{day.strftime('%Y%m%d')}"
+        bounds = f"for values from ('{day}') to ('{next_day}')"
+
+        if table_exists(conn, partition_name):
+            continue
+
+        if not has_default:
+            conn.execute(
+                text(
+                    f"create table public.{partition_name} "
+                    f"partition of public.{table_name} {bounds}"
+                )
+            )
+            continue
+
+        # Partition is filled with rows of its day from default
+        # partition before it is attached
+        conn.execute(
+            text(
+                f"create table public.{partition_name} "
+                f"(like public.{table_name} including defaults)"
+            )
+        )
+        moved = conn.execute(
+            text(
+                f"with moved as (delete from public.{default_name} "
+                f"where create_timestamp >= '{day}' "
+                f"and create_timestamp < '{next_day}' returning *) "
+                f"insert into public.{partition_name} select * from moved"
+            )
+        ).rowcount
+        conn.execute(
+            text(
+                f"alter table public.{table_name} "
+                f"attach partition public.{partition_name} {bounds}"
+            )
+        )
+
+        if moved:
+            logger.info(f"{moved} rows moved from {default_name} into {day} partition")
+
+    logger.info(f"Partitions of {table_name} ready till {date_to}")
+
+
+def partition_table(logger, conn, table_name, days_ahead):
+    """
+    Converts table into table partitioned by day of create_timestamp.
+    Old rows are copied over, old table is kept as <table>_unpartitioned
+    """
+    old_name = f"{table_name}_unpartitioned"
+    today = datetime.date.today()
+
+    logger.info(f"Partitioning {table_name} by day")
+
+    # Index names have to be free for the new partitioned table
+    for index_name, index_table_name, _ in INDEXES:
+        if index_table_name == table_name:
+            conn.execute(text(f"drop index if exists public.{index_name}"))
+
+    conn.execute(text(f"alter table public.{table_name} rename to {old_name}"))
+    conn.execute(
+        text(
+            f"create table public.{table_name} "
+            f"(like public.{old_name} including defaults) "
+            f"partition by range (create_timestamp)"
+        )
+    )
+
+    first_day = conn.execute(
+        text(f"select min(create_timestamp)::date from public.{old_name}")
+    ).scalar()
+
+    create_daily_partitions(
+        logger,
+        conn,
+        table_name,
+        first_day or today,
+        today + datetime.timedelta(days=days_ahead),
+    )
+    conn.execute(
+        text(
+            f"create table if not exists public.{table_name}_default "
+            f"partition of public.{table_name} default"
+        )
+    )
+
+    conn.execute(
+        text(f"insert into public.{table_name} select * from public.{old_name}")
+    )
+    logger.info(f"Rows copied from {old_name}, drop it once checked")
+
+
+def migrate(logger, credentials, partition=False, days_ahead=7):
+    """
+    Creates missing tables, adds typed columns, creates offers history
+    and indexes and, optionally, partitions both tables by day.
+    Safe to run repeatedly, on already partitioned tables it only
+    adds partitions for the next days_ahead days and for days whose
+    rows landed in default partition
+    """
+    engine = get_engine(credentials)
+    today = datetime.date.today()
+
+    with engine.begin() as conn:
+        create_tables(logger, conn)
+        add_columns(logger, conn)
+
+        for table_name in TABLES:
+            if is_partitioned(conn, table_name):
+                # Days missed by migration, their rows are in default partition
+                first_day = default_partition_first_day(conn, table_name)
+                create_daily_partitions(
+                    logger,
+                    conn,
+                    table_name,
+                    min(first_day or today, today),
+                    today + datetime.timedelta(days=days_ahead),
+                )
+            elif partition:
+                partition_table(logger, conn, table_name, days_ahead)
+
+        create_history(logger, conn)
+        create_indexes(logger, conn)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--partition", help="partition tables by day", action="store_true"
+    )
+    parser.add_argument(
+        "--days_ahead", help="daily partitions to create ahead", type=int, default=7
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
+    logger = logging.getLogger(APP_NAME)
+    logger.info(f"Starting {APP_NAME}")
+
+    migrate(logger, get_creds(), partition=args.partition, days_ahead=args.days_ahead)
+
+    logger.info(f"{APP_NAME} finished")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
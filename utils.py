@@ -1,5 +1,10 @@
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import text
+
+from bulk_writer import quote
+from database import day_range, get_engine
+
+CHUNK_SIZE = 50000
 
 
 def get_creds(filename="database.txt"):
@@ -17,29 +22,62 @@ def get_creds(filename="database.txt"):
     return credentials
 
 
-def load_offers_params_table(credentials, date_from="", date_to="", limit=0):
+def offers_params_query(date_from="", date_to="", columns=None, limit=0):
     """
-    Connects with PostgreSQL DB and get
-    offers params for selected dates
+    Query of offers params for selected dates and columns
+    with dates and limit passed as bound parameters
     """
+    select = ", ".join([quote(column) for column in columns]) if columns else "*"
 
-    engine = create_engine(
-        f"postgresql://{credentials['username']}:{credentials['password']}"
-        f"@{credentials['host']}:{credentials['port']}/{credentials['database']}"
-    )
-
-    query = "select * from public.otodom_offers_params where 1=1"
+    query = f"select {select} from public.otodom_offers_params where 1=1"
+    params = dict()
 
     # Dates
-    if len(date_from) > 0 and len(date_to) == 0:
-        query = f"{query} and date(create_timestamp) = '{date_from}'"
-    elif len(date_from) > 0 and len(date_to) > 0:
-        query = f"{query} and date(create_timestamp) between '{date_from}' and '{date_to}'"
+    if len(date_from) > 0:
+        params["date_start"], params["date_end"] = day_range(date_from, date_to)
+        query = (
+            f"{query} and create_timestamp >= :date_start"
+            " and create_timestamp < :date_end"
+        )
 
     # Limit
     if limit > 0:
-        query = f"{query} limit {limit}"
+        params["limit"] = limit
+        query = f"{query} limit :limit"
+
+    return text(query), params
+
+
+def load_offers_params_table(
+    credentials, date_from="", date_to="", limit=0, columns=None
+):
+    """
+    Connects with PostgreSQL DB and get
+    offers params for selected dates
+    """
+
+    engine = get_engine(credentials)
 
-    df = pd.read_sql_query(query, engine)
+    query, params = offers_params_query(date_from, date_to, columns, limit)
+    df = pd.read_sql_query(query, engine, params=params)
 
     return df
+
+
+def iter_offers_params_table(
+    credentials, date_from="", date_to="", columns=None, chunk_size=CHUNK_SIZE
+):
+    """
+    Yields offers params for selected dates as DataFrames of chunk_size
+    rows read through server-side cursor, so only one chunk is kept in
+    memory at a time
+    """
+
+    engine = get_engine(credentials)
+
+    query, params = offers_params_query(date_from, date_to, columns)
+
+    with engine.connect().execution_options(
+        stream_results=True, max_row_buffer=chunk_size
+    ) as conn:
+        yield from pd.read_sql_query(query, conn, params=params, chunksize=chunk_size)